@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+
+DEFAULT_ARCHIVE = os.environ.get("FEEDBOT_ARCHIVE")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS feedback (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    run TEXT NOT NULL,
+    assignment TEXT NOT NULL,
+    problem TEXT NOT NULL,
+    submission TEXT,
+    submission_hash TEXT,
+    submitter TEXT,
+    config TEXT,
+    config_hash TEXT NOT NULL,
+    model TEXT NOT NULL,
+    sample INTEGER NOT NULL,
+    code TEXT,
+    prompt TEXT,
+    text TEXT,
+    stats TEXT
+);
+CREATE INDEX IF NOT EXISTS feedback_assignment ON feedback (assignment, problem);
+CREATE INDEX IF NOT EXISTS feedback_problem ON feedback (problem);
+CREATE INDEX IF NOT EXISTS feedback_submission_hash ON feedback (submission_hash);
+CREATE INDEX IF NOT EXISTS feedback_config_hash ON feedback (config_hash);
+CREATE INDEX IF NOT EXISTS feedback_model ON feedback (model);
+"""
+
+# Columns that can be filtered on, all indexed
+FILTERS = ["assignment", "problem", "submission_hash", "config_hash", "model"]
+COLUMNS = ["id", "created", "run", "assignment", "problem", "submission", "submission_hash", "submitter", "config",
+           "config_hash", "model", "sample", "code", "prompt", "text", "stats"]
+
+# An append-only SQLite archive of every comment FeedBot has given: one row per problem (and per sample,
+# if the config asked for several) of each graded submission, with the assignment, problem path, a hash of
+# the submission file and of the config, and the model that answered. Rows are only ever added, so
+# comments from different configs, models and terms can be compared with indexed lookups.
+class FeedbackArchive:
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # several graders (e.g. a daemon and batch_test) may write to one archive
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA busy_timeout=10000")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def record(self, assignment, config, comments, submission_path=None, submitter=None, config_name=None, submission_hash=None):
+        """
+        Adds the comments from grading one submission with a config. Returns the id of this run.
+        Problems that could not be graded are not recorded, since no model gave their comment.
+        The submission is hashed from submission_path, unless its hash is given
+
+        """
+        run = uuid.uuid4().hex
+        created = time.time()
+        if submission_hash is None and submission_path is not None:
+            submission_hash = file_hash(submission_path)
+        rows = []
+        for comment in comments:
+            if comment["text"] == "ERROR":
+                continue
+            stats = comment.get("stats", {})
+            for sample, text in enumerate(comment.get("samples", [comment["text"]])):
+                rows.append((created, run, assignment.title, comment["path"], submission_path, submission_hash, submitter or None,
+                             config_name, config_hash(config), answering_model(comment, config, sample), sample,
+                             comment["code"], comment["prompt"], text, json.dumps(stats)))
+        with self.db:
+            self.db.executemany("INSERT INTO feedback (created, run, assignment, problem, submission, submission_hash, submitter, config, "
+                                "config_hash, model, sample, code, prompt, text, stats) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return run
+
+    def query(self, limit=None, **filters):
+        """
+        Yields the archived comments (as dicts, oldest first) matching the given column values,
+        e.g. query(assignment="HW 3", problem="Problem 2, Part B")
+
+        """
+        unknown = set(filters) - set(FILTERS)
+        if unknown:
+            raise ValueError(f"Cannot filter on {', '.join(sorted(unknown))}")
+        conditions = [(column, value) for column, value in filters.items() if value is not None]
+        sql = f"SELECT {', '.join(COLUMNS)} FROM feedback"
+        if conditions:
+            sql += " WHERE " + " AND ".join(f"{column} = ?" for column, _ in conditions)
+        sql += " ORDER BY id"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        cursor = self.db.execute(sql, [value for _, value in conditions])
+        for row in cursor:
+            yield dict(zip(COLUMNS, row))
+
+# Returns a hash of a config, by its contents. The number of samples is left out, since it does not
+# change what a single comment is given
+# dict -> str
+def config_hash(config):
+    contents = { k: v for k, v in config.items() if k != "samples" }
+    return hashlib.sha256(json.dumps(contents, sort_keys=True).encode("utf-8")).hexdigest()
+
+# Returns a hash of a file's contents, or None if it cannot be read
+# str -> str
+def file_hash(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+# Returns the model that gave a comment (or one of its samples): the tier that answered, if the config
+# has a cascade, or none for the canned comment on an unstarted problem
+# (dict, dict, int) -> str
+def answering_model(comment, config, sample=0):
+    if comment.get("stats", {}).get("unstarted"):
+        return ""
+    sample_models = comment.get("stats", {}).get("sample_models")
+    if sample_models:
+        return sample_models[sample]
+    tiers = comment.get("stats", {}).get("tiers")
+    if tiers:
+        return tiers[-1]["model"]
+    return config["model"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='FeedBot feedback archive'
+    )
+
+    parser.add_argument('archive', nargs='?', default = DEFAULT_ARCHIVE)
+    parser.add_argument('--assignment')
+    parser.add_argument('--problem', help="problem path, as in the results, e.g. \"Problem 2, Part B\"")
+    parser.add_argument('--submission-hash')
+    parser.add_argument('--config-hash')
+    parser.add_argument('--model')
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--fields', default = "created,assignment,problem,submission,config,config_hash,model,sample,text",
+                        help="comma-separated columns to print (or all)")
+    parser.add_argument('--csv', action='store_true', help="print CSV instead of JSON lines")
+
+    args = parser.parse_args()
+
+    if args.archive is None:
+        parser.error("no archive given (or set in FEEDBOT_ARCHIVE)")
+    if not os.path.exists(args.archive):
+        parser.error(f"{args.archive} does not exist")
+
+    fields = COLUMNS if args.fields == "all" else args.fields.split(",")
+    archive = FeedbackArchive(args.archive)
+    rows = archive.query(args.limit, assignment=args.assignment, problem=args.problem, submission_hash=args.submission_hash,
+                         config_hash=args.config_hash, model=args.model)
+    if args.csv:
+        writer = csv.DictWriter(sys.stdout, fields, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            print(json.dumps({ field: row[field] for field in fields }))
+    archive.close()
@@ -1,7 +1,19 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
 import json
+import os
+import logging
+logger = logging.getLogger(__name__)
 
-from submission import SubmissionTemplate, MARKER
+from submission import SubmissionTemplate, MARKER, normalize_response, response_digest
 from validate import validateJson, validateAssignmentProb, json_has, json_has_or
+from metrics import span
+
+# Bumped whenever the bundle layout (or anything a ProblemStatement resolves from the template) changes
+BUNDLE_VERSION = 2
+BUNDLE_FIELDS = ["path", "context", "statement", "title", "stub", "tags", "dependencies", "grading_note", "starter_digest"]
 
 
 #Represents a single problem in an assignment along with its metadata
@@ -16,6 +28,7 @@ class ProblemStatement:
         self.tags = json_has_or(prob_data, "tags", list, [])
         self.dependencies = json_has_or(prob_data, "dependencies", list, [])
         self.grading_note = json_has_or(prob_data, "grading_note", str, "")
+        self.starter_digest = response_digest(template.response(self.path))
     
     def retrieve_problem_context(self, template): 
         """
@@ -28,6 +41,25 @@ class ProblemStatement:
             prob_context += "\n\n"
         return prob_context
 
+    def is_unstarted(self, code):
+        """
+        Returns whether a student response is blank, or the same as the template's response (ignoring whitespace)
+        """
+        return normalize_response(code) == "" or response_digest(code) == self.starter_digest
+
+    @staticmethod
+    def from_bundle(data):
+        """
+        Returns the problem saved in a bundle, as already resolved and validated when it was compiled
+        """
+        problem = ProblemStatement.__new__(ProblemStatement)
+        for field in BUNDLE_FIELDS:
+            setattr(problem, field, data[field])
+        return problem
+
+    def to_bundle(self):
+        return { field: getattr(self, field) for field in BUNDLE_FIELDS }
+
         
 
 
@@ -35,7 +67,24 @@ class ProblemStatement:
 #Represents an entire assignment (a list of problems) along with its metadata
 class AssignmentStatement:
     @staticmethod
-    def load(spec_path, template_path):
+    def load(spec_path, template_path, bundle_path=None):
+        """
+        Loads the assignment from its compiled bundle (by default, next to the spec; see compile)
+        if there is one and it was compiled from these exact spec and template files. Otherwise
+        parses and validates the spec and template.
+        """
+        if bundle_path is None:
+            bundle_path = default_bundle_path(spec_path)
+        with span("assignment_load", source="bundle") as attrs:
+            if os.path.exists(bundle_path):
+                assignment = AssignmentStatement.load_bundle(bundle_path, spec_path, template_path)
+                if assignment is not None:
+                    return assignment
+            attrs["source"] = "parse"
+            return AssignmentStatement.parse(spec_path, template_path)
+
+    @staticmethod
+    def parse(spec_path, template_path):
         template = SubmissionTemplate.load(template_path)
         with open(spec_path,'r') as f:
             c = json.load(f)
@@ -47,4 +96,74 @@ class AssignmentStatement:
         self.title = jsondata["title"]
         self.problems = []
         for prob in jsondata["problems"]:
-            self.problems.append(ProblemStatement(prob, template))
\ No newline at end of file
+            self.problems.append(ProblemStatement(prob, template))
+
+    @staticmethod
+    def load_bundle(bundle_path, spec_path, template_path):
+        """
+        Returns the assignment in a bundle, or None if the bundle is from another version
+        or its source hashes do not match the spec and template files
+        """
+        try:
+            with open(bundle_path, 'r') as f:
+                bundle = json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Could not read {bundle_path}, parsing the assignment instead")
+            return None
+        if bundle.get("version") != BUNDLE_VERSION:
+            logger.warning(f"{bundle_path} is from another version of FeedBot, parsing the assignment instead")
+            return None
+        if bundle.get("sources") != source_hashes(spec_path, template_path):
+            logger.warning(f"{bundle_path} is out of date, parsing the assignment instead")
+            return None
+
+        assignment = AssignmentStatement.__new__(AssignmentStatement)
+        assignment.title = bundle["title"]
+        assignment.problems = [ProblemStatement.from_bundle(prob) for prob in bundle["problems"]]
+        return assignment
+
+    @staticmethod
+    def compile(spec_path, template_path, bundle_path=None):
+        """
+        Parses and validates the assignment, and saves it as a bundle (by default, next to the spec)
+        that load can read without touching the template again. Returns the bundle path
+        """
+        if bundle_path is None:
+            bundle_path = default_bundle_path(spec_path)
+        assignment = AssignmentStatement.parse(spec_path, template_path)
+        bundle = {
+            "version": BUNDLE_VERSION,
+            "sources": source_hashes(spec_path, template_path),
+            "title": assignment.title,
+            "problems": [prob.to_bundle() for prob in assignment.problems]
+        }
+        tmp = bundle_path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(bundle, f, separators=(",", ":"))
+        os.replace(tmp, bundle_path)
+        return bundle_path
+
+# Returns where the compiled bundle of the assignment with this spec is saved by default
+def default_bundle_path(spec_path):
+    return os.path.splitext(spec_path)[0] + ".bundle.json"
+
+# Returns the hashes of the spec and template files an assignment is compiled from
+def source_hashes(spec_path, template_path):
+    hashes = {}
+    for name, path in [("spec", spec_path), ("template", template_path)]:
+        with open(path, 'rb') as f:
+            hashes[name] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='FeedBot assignment compiler'
+    )
+
+    parser.add_argument('-a', '--assignment', required = True)
+    parser.add_argument('-j', '--spec', required = True)
+    parser.add_argument('-o', '--output')
+
+    args = parser.parse_args()
+
+    print(AssignmentStatement.compile(args.spec, args.assignment, args.output))
\ No newline at end of file
@@ -0,0 +1,260 @@
+import asyncio
+import json
+import os
+import tarfile
+import tempfile
+import time
+import zipfile
+import logging
+logger = logging.getLogger(__name__)
+
+from submission import SubmissionTemplate
+from starter_checker import follows_starter, StarterFingerprint
+from validate import validateSubmissionProb
+from query import build_prompt, build_request, postprocess, render_path, unstarted_comment
+from retry import RetryPolicy
+
+ENDPOINT = "/v1/chat/completions"
+FINISHED = ("completed", "failed", "expired", "cancelled")
+
+# Submits a JSONL batch file to the OpenAI Batch API and fetches its results.
+# Every call is retried under a RetryPolicy, since a batch can be polled for hours and one
+# transient error should not end the job; the timeout is long enough for uploading a large batch file.
+class OpenAIBatchBackend:
+    def __init__(self, client, retry=None):
+        self.client = client
+        self.retry = retry if retry is not None else RetryPolicy(timeout=600, max_attempts=5, base_delay=5, max_delay=120)
+
+    async def submit(self, input_path):
+        """
+        Uploads the batch file and starts the batch. Returns the batch id
+
+        """
+        async def upload():
+            with open(input_path, 'rb') as f:
+                return await self.client.files.create(file=f, purpose="batch")
+        input_file = await self.retry.run(upload)
+        batch = await self.retry.run(lambda: self.client.batches.create(input_file_id=input_file.id, endpoint=ENDPOINT, completion_window="24h"))
+        return batch.id
+
+    async def poll(self, batch_id):
+        """
+        Returns (status, output lines), where the output lines are only given once the batch has finished
+
+        """
+        batch = await self.retry.run(lambda: self.client.batches.retrieve(batch_id))
+        if batch.status not in FINISHED:
+            return batch.status, None
+        lines = []
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if file_id is not None:
+                content = await self.retry.run(lambda: self.client.files.content(file_id))
+                lines += [line for line in content.text.splitlines() if line.strip()]
+        return batch.status, lines
+
+# A local stand-in for the Batch API, for testing: runs every request in the batch file through
+# the client's chat completions endpoint (e.g. a mock server) and answers in the Batch output format
+class LocalBatchBackend:
+    def __init__(self, client, limiter=None, retry=None):
+        self.client = client
+        self.limiter = limiter
+        self.retry = retry
+        self.batches = {}
+
+    async def _run(self, line):
+        request = json.loads(line)
+
+        admit = (lambda: self.limiter.acquire(0)) if self.limiter is not None else None
+
+        async def attempt(reservation=None):
+            completion = await self.client.chat.completions.create(**request["body"])
+            if reservation is not None:
+                reservation.settle(completion.usage.total_tokens if completion.usage is not None else None)
+            return completion
+
+        try:
+            if self.retry is not None:
+                completion = await self.retry.run(attempt, admit=admit)
+            elif admit is not None:
+                async with admit() as reservation:
+                    completion = await attempt(reservation)
+            else:
+                completion = await attempt()
+            return json.dumps({ "custom_id": request["custom_id"], "response": { "status_code": 200, "body": completion.model_dump() }, "error": None })
+        except Exception as e:
+            logger.exception('')
+            return json.dumps({ "custom_id": request["custom_id"], "response": None, "error": { "message": str(e) } })
+
+    async def submit(self, input_path):
+        with open(input_path, 'r') as f:
+            lines = [line for line in f if line.strip()]
+        batch_id = f"local-batch-{len(self.batches)}"
+        self.batches[batch_id] = await asyncio.gather(*[self._run(line) for line in lines])
+        return batch_id
+
+    async def poll(self, batch_id):
+        return "completed", self.batches[batch_id]
+
+# Returns the paths of all .rkt submissions in a directory, or in a .zip/.tar(.gz) archive,
+# which is extracted into extract_dir
+def find_submissions(submissions_path, extract_dir):
+    if os.path.isfile(submissions_path):
+        if zipfile.is_zipfile(submissions_path):
+            with zipfile.ZipFile(submissions_path) as archive:
+                archive.extractall(extract_dir)
+        else:
+            with tarfile.open(submissions_path) as archive:
+                archive.extractall(extract_dir, filter="data")
+        submissions_path = extract_dir
+
+    paths = []
+    for root, _, files in os.walk(submissions_path):
+        paths += [os.path.join(root, f) for f in files if f.endswith(".rkt")]
+    return sorted(paths)
+
+# Returns the id of the batch saved in a batch_state.json, or None if there is none
+# Raises ValueError if the saved batch has a different number of requests than the batch file
+# (str, int) -> str | None
+def saved_batch(state_path, requests):
+    if not os.path.exists(state_path):
+        logger.warning(f"No batch to resume in {state_path}, submitting a new one")
+        return None
+    with open(state_path, 'r') as f:
+        state = json.load(f)
+    if state["requests"] != requests:
+        raise ValueError(f"The batch in {state_path} has {state['requests']} requests, but the submissions make {requests}")
+    return state["batch_id"]
+
+# Returns the name a submission's results are saved under: its path relative to the submissions folder
+def submission_name(path, root):
+    return os.path.relpath(path, root).replace(os.sep, "---").rsplit(".", 1)[0]
+
+# Grades a whole folder or archive of submissions through a Batch-API-style pipeline:
+# builds every (submission, problem) prompt, submits them as one JSONL batch file,
+# polls until it finishes, then post-processes, saves and (optionally) posts each submission's comments.
+# In a dry run, only the batch file is written. Posts go through the given ResultPoster, or a new one.
+# The comments are also added to the FeedbackArchive, if one is given.
+# The submitted batch is saved in batch_state.json in the results folder; with resume, the batch
+# saved there is polled again (e.g. after the job was stopped) instead of submitting a new one.
+# Returns a dict from submission name to its list of comments
+async def grade_batch(backend, assignment, template_path, submissions_path, config, problem_number, results_folder_path,
+                      post_url=None, post_key=None, emails=None, poll_interval=60, dry_run=False, poster=None, archive=None, resume=False):
+    from main import send_request
+    from archive import file_hash
+    from poster import ResultPoster
+
+    if emails is None:
+        emails = {}
+    os.makedirs(results_folder_path, exist_ok=True)
+    probs = assignment.problems if problem_number is None else [assignment.problems[problem_number]]
+
+    starter = StarterFingerprint.load(template_path)
+    with tempfile.TemporaryDirectory() as extract_dir:
+        paths = find_submissions(submissions_path, extract_dir)
+        root = extract_dir if os.path.isfile(submissions_path) else submissions_path
+
+        comments = {}
+        # hashed now, as an extracted archive is gone by the time the comments are in
+        hashes = {}
+        requests = 0
+        input_path = os.path.join(results_folder_path, "batch_input.jsonl")
+        with open(input_path, 'w') as batch_file:
+            for path in paths:
+                name = submission_name(path, root)
+                submission = SubmissionTemplate.load(path)
+                output_lines = []
+                if not follows_starter(output_lines, submission, starter):
+                    logger.warning(f"Skipping {name}, which does not follow the starter code")
+                    continue
+                comments[name] = []
+                if archive is not None:
+                    hashes[name] = file_hash(path)
+                for i, problem in enumerate(probs):
+                    res = { "path": render_path(problem.path), "prompt": "ERROR", "text": "ERROR", "code": "ERROR", "stats": {} }
+                    try:
+                        validateSubmissionProb(problem.path, submission)
+                        code = submission.at(problem.path, True).contents()
+                        canned = unstarted_comment(problem, config)
+                        if canned is not None and problem.is_unstarted(code):
+                            res.update({ "prompt": "none", "text": canned, "code": code, "stats": { "unstarted": True } })
+                        else:
+                            prompt, segment_tokens = build_prompt(problem, code, assignment, config, submission.extract_responses(problem.dependencies))
+                            res.update({ "prompt": prompt, "text": "none", "code": code, "stats": { "segment_tokens": segment_tokens } })
+                            request = { "custom_id": f"{name}|{i}", "method": "POST", "url": ENDPOINT,
+                                        "body": build_request(config["model"], prompt, config["system"]) }
+                            batch_file.write(json.dumps(request) + "\n")
+                            requests += 1
+                    except:
+                        logger.exception('')
+                    comments[name].append(res)
+
+    if dry_run:
+        logger.info(f"Dry run: wrote {requests} requests to {input_path}")
+        return comments
+
+    output_lines = []
+    if requests > 0:
+        state_path = os.path.join(results_folder_path, "batch_state.json")
+        batch_id = None
+        if resume:
+            batch_id = saved_batch(state_path, requests)
+        if batch_id is None:
+            batch_id = await backend.submit(input_path)
+            logger.info(f"Submitted batch {batch_id} with {requests} requests")
+            with open(state_path, 'w') as f:
+                json.dump({ "batch_id": batch_id, "requests": requests, "submitted": time.time() }, f)
+        else:
+            logger.info(f"Resuming batch {batch_id} with {requests} requests")
+
+        while True:
+            status, output_lines = await backend.poll(batch_id)
+            if output_lines is not None:
+                break
+            logger.info(f"Batch {batch_id} is {status}")
+            await asyncio.sleep(poll_interval)
+        logger.info(f"Batch {batch_id} {status}")
+
+    for line in output_lines:
+        output = json.loads(line)
+        name, i = output["custom_id"].rsplit("|", 1)
+        res = comments[name][int(i)]
+        response = output.get("response")
+        if response is None or response["status_code"] != 200:
+            logger.error(f"Batch request {output['custom_id']} failed: {output.get('error')}")
+            res.update({ "prompt": "ERROR", "text": "ERROR", "code": "ERROR" })
+            continue
+        body = response["body"]
+        res["text"] = postprocess(body["choices"][0]["message"]["content"], config)
+        usage = body.get("usage")
+        if usage is not None:
+            res["stats"]["prompt_tokens"] = usage["prompt_tokens"]
+            res["stats"]["cached_tokens"] = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+            res["stats"]["completion_tokens"] = usage["completion_tokens"]
+
+    own_poster = post_url and poster is None
+    if own_poster:
+        poster = ResultPoster()
+    try:
+        for name, answer in comments.items():
+            for res in answer:
+                # a request that never came back, e.g. because the batch expired
+                if res["text"] == "none":
+                    res.update({ "prompt": "ERROR", "text": "ERROR", "code": "ERROR" })
+            with open(os.path.join(results_folder_path, f"{name}.json"), 'w') as f:
+                json.dump(answer, f)
+            if post_url:
+                response = await send_request(poster, post_url, post_key, answer, emails.get(name, ""))
+                if response is None:
+                    logger.error(f"Did not post {name} successfully, saved it to be posted later")
+                elif response.status_code != 200:
+                    logger.error(f"Did not post {name} successfully: " + response.text)
+            if archive is not None:
+                try:
+                    archive.record(assignment, config, answer, name, emails.get(name), submission_hash=hashes[name])
+                except Exception:
+                    logger.exception(f"Could not add the comments on {name} to the archive")
+    finally:
+        if own_poster:
+            await poster.close()
+
+    return comments
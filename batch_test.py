@@ -1,18 +1,112 @@
 import argparse
+import asyncio
 import logging
 import os
 import json
 import html
 import time
-from main import process
+from main import grade, make_client
+from assignment import AssignmentStatement
+from submission import SubmissionTemplate
+from starter_checker import follows_starter, StarterFingerprint
+from ratelimit import RateLimiter
+from retry import RetryPolicy
+from archive import FeedbackArchive, DEFAULT_ARCHIVE
+import metrics
+
+# Returns the path of the result file for the run of a submission with a config
+def result_file_path(result_folder_path, sub, config):
+    sub_name = sub.split('.')[0]
+    config_name = config.split('.')[0]
+    return os.path.join(result_folder_path, f"{sub_name}---{config_name}.json")
+
+# Returns the path of the results log, which has one JSON line per sample of each problem of every finished run
+def log_file_path(result_folder_path):
+    return os.path.join(result_folder_path, "results.jsonl")
+
+# Returns the path of a new timestamped HTML report
+def report_file_path(result_folder_path):
+    return os.path.join(result_folder_path, "report" + time.strftime("%Y-%m-%d-%H%M%S") + ".html")
+
+# Appends the entries of one finished run to the results log, one per sample of each problem
+def append_to_log(log, sub, config, result_path):
+    with open(result_path, 'r') as result:
+        data = json.load(result)
+    for index, entry in enumerate(data):
+        for i, text in enumerate(entry.get('samples', [entry['text']])):
+            log.write(json.dumps({
+                'sub': sub,
+                'config': config,
+                'run': i,
+                'index': index,
+                'path': entry['path'],
+                'code': entry['code'],
+                'prompt': entry['prompt'],
+                'text': text
+            }) + "\n")
+    log.flush()
 
 # Escapes text for use in HTML, and replaces line breaks with <br>
 def html_escape(txt):
     return html.escape(txt).replace("\n", "<br />")
 
+# Runs every (submission, config) job concurrently, sharing one client, the parsed assignment
+# and the parsed submissions (by path)
+# Jobs whose result file already exists are skipped, so an interrupted sweep can be resumed
+# Progress is written to manifest.json in the result folder after every job
+# Each finished run is also added to the FeedbackArchive, if one is given
+async def run_jobs(jobs, client, assignment, configs, prob_num, result_folder_path, max_jobs, limiter=None, retry=None, submissions=None, archive=None):
+    if submissions is None:
+        submissions = {}
+    log = open(log_file_path(result_folder_path), 'a', encoding="utf-8")
+    manifest_path = os.path.join(result_folder_path, "manifest.json")
+    manifest = { "total": len(jobs), "done": 0, "skipped": 0, "failed": 0, "jobs": {} }
+    slots = asyncio.Semaphore(max_jobs)
+
+    def save_manifest():
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+    async def run_job(sub_path, config, result_path):
+        name = os.path.basename(result_path)
+        if os.path.exists(result_path):
+            manifest["skipped"] += 1
+            manifest["jobs"][name] = "skipped"
+            return
+        async with slots:
+            tmp_path = result_path + ".tmp"
+            try:
+                await grade(client, assignment, sub_path, configs[config], prob_num, None, tmp_path, None, None, None, limiter, retry,
+                            submission=submissions.get(sub_path))
+                append_to_log(log, os.path.basename(sub_path), config, tmp_path)
+                if archive is not None:
+                    with open(tmp_path, 'r') as result:
+                        archive.record(assignment, configs[config], json.load(result), sub_path, config_name=config)
+                os.replace(tmp_path, result_path)
+                manifest["done"] += 1
+                manifest["jobs"][name] = "done"
+            except Exception:
+                logging.exception(f"Job {name} failed")
+                manifest["failed"] += 1
+                manifest["jobs"][name] = "failed"
+        save_manifest()
+        logging.info(f"{manifest['done'] + manifest['skipped'] + manifest['failed']}/{manifest['total']} jobs finished")
+
+    try:
+        await asyncio.gather(*[run_job(*job) for job in jobs])
+    finally:
+        log.close()
+        save_manifest()
+    return manifest
+
 # Gets feedback for each submission in a folder crossed with each config in a folder, count number of times
-# Generates a simple HTML report for easy-ish reviewing of the responses
-def batch_test(sub_folder_path, config_folder_path, result_folder_path, assignment_path, spec_path, count, prob_num):
+# The count samples of each problem's feedback come from one request, or from one run through the cascade
+# each, for a config with a "cascade" (see the "samples" config key)
+# Each finished run is appended to results.jsonl, which the HTML report is then rendered from,
+# and to the feedback archive at archive_path (by default, archive.sqlite in the result folder)
+def batch_test(sub_folder_path, config_folder_path, result_folder_path, assignment_path, spec_path, count, prob_num, limiter=None, retry=None, max_jobs=4, archive_path=None):
     subs = os.listdir(sub_folder_path)
     subs = [f for f in subs if os.path.isfile(os.path.join(sub_folder_path, f))]
 
@@ -22,102 +116,141 @@ def batch_test(sub_folder_path, config_folder_path, result_folder_path, assignme
     prob_log = f"problem {prob_num}" if prob_num else "all problems"
     test_log = f"Testing submissions {subs} with configs {configs}, {count} times each, on {prob_log}"
     logging.info(test_log)
-    
-    prob_data = {}
 
+    assignment = AssignmentStatement.load(spec_path, assignment_path)
+    config_data = {}
+    for config in configs:
+        with open(os.path.join(config_folder_path, config), 'r') as f:
+            config_data[config] = json.load(f)
+        if count > 1:
+            config_data[config]["samples"] = count
+
+    starter = StarterFingerprint.load(assignment_path)
+    submissions = {}
+    jobs = []
     for sub in subs:
+        sub_path = os.path.join(sub_folder_path, sub)
+        submissions[sub_path] = SubmissionTemplate.load(sub_path)
+        output_lines = []
+        if not follows_starter(output_lines, submissions[sub_path], starter):
+            logging.warning(f"Skipping {sub}, which does not follow the starter code")
+            continue
         for config in configs:
-            for i in range(count):
-                sub_path = os.path.join(sub_folder_path, sub)
-                sub_name = sub.split('.')[0]
-                config_path = os.path.join(config_folder_path, config)
-                config_name = config.split('.')[0]
-                result_path = os.path.join(result_folder_path, f"{sub_name}---{config_name}---{i}.json")
-
-                process(spec_path, assignment_path, sub_path, config_path, prob_num, None, result_path, None, None, True)
-                time.sleep(10)
-
-                with open(result_path, 'r') as result:
-                    data = json.load(result)
-                    for entry in data:
-                        res_key = f"{entry['path']} ~ {sub}"
-                        res_data = {
-                            'config': config,
-                            'prompt': entry['prompt'],
-                            'text': entry['text']
-                        }
-                        if res_key in prob_data:
-                            prob_data[res_key]['responses'].append(res_data)
-                        else:
-                            new_prob = {
-                                'path': entry['path'],
-                                'sub': sub,
-                                'code': entry['code'],
-                                'responses': [res_data]
-                            }
-                            prob_data[res_key] = new_prob
-    
-    prob_html = ""
-
-    for res_key in prob_data:
-        prob = prob_data[res_key]
-        prob_html += f"<h1>{prob['path']}</h1><h3>{prob['sub']}</h3>"
-        code_lines = len(prob['code'].split('\n'))
-        prob_html += f"<pre>{prob['code']}</pre>"
-        # todo: show prompt but put it in a drop-down that you click to expand
-        prob_html += "<table>"
-        for res in sorted(prob['responses'], key=lambda res: res['config']):
-            text_lines = len(res['text'].split('\n'))
-            prob_html += f"<tr><td><h3>{html_escape(res['config'])}</h3><div>{html_escape(res['text'])}</div></td></tr>"
-        prob_html += "</table>"
-    
-    html_content = \
-f"""
+            jobs.append((sub_path, config, result_file_path(result_folder_path, sub, config)))
+
+    client = make_client(os.environ["OPENAI_KEY"], retry)
+    archive = FeedbackArchive(archive_path if archive_path is not None else os.path.join(result_folder_path, "archive.sqlite"))
+    try:
+        asyncio.run(run_jobs(jobs, client, assignment, config_data, prob_num, result_folder_path, max_jobs, limiter, retry, submissions, archive))
+    finally:
+        archive.close()
+
+    write_report(log_file_path(result_folder_path), report_file_path(result_folder_path), test_log)
+
+REPORT_HEAD = \
+"""
 <html>
     <head>
         <title>Report</title>
         <style>
-        table {{
+        table {
             border-collapse: collapse;
             margin: 5px;
-        }}
-        td {{
+        }
+        td {
             border: 2px solid black;
             padding: 5px;
-        }}
-        pre {{
+        }
+        pre {
             margin: 5px;
             font-family: monospace;
             background-color: light-gray;
             padding: 5px;
             border: 1px solid black;
-        }}
+        }
         </style>
     </head>
     <body>
-    <div>{test_log}</div>
-    <div>{prob_html}</div>
+"""
+
+REPORT_TAIL = \
+"""
     </body>
 </html>
 """
 
-    with open(os.path.join(result_folder_path, "report" + time.strftime("%Y-%m-%d-%H%M%S") + ".html"), 'w', encoding="utf-8") as report:
-        report.write(html_content)
+# Generates a simple HTML report for easy-ish reviewing of the responses in a results log
+# The log is read twice: once to index where each (problem, submission) group's entries are,
+# then once per group, so only one group is held in memory at a time
+def write_report(log_path, report_path, test_log):
+    groups = {}
+    with open(log_path, 'rb') as log:
+        while True:
+            offset = log.tell()
+            line = log.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a line cut short by an interrupted run
+                continue
+            group = groups.setdefault((entry['sub'], entry['path']), { 'order': entry['index'], 'runs': {} })
+            # a job that was run again after an interruption replaces its earlier entry
+            group['runs'][(entry['config'], entry['run'])] = offset
+
+    with open(log_path, 'rb') as log, open(report_path, 'w', encoding="utf-8") as report:
+        report.write(REPORT_HEAD)
+        report.write(f"<div>{html_escape(test_log)}</div>\n<div>")
+        for (sub, path), group in sorted(groups.items(), key=lambda item: (item[0][0], item[1]['order'], item[0][1])):
+            entries = []
+            for key in sorted(group['runs']):
+                log.seek(group['runs'][key])
+                entries.append(json.loads(log.readline()))
+            report.write(f"<h1>{html.escape(path)}</h1><h3>{html.escape(sub)}</h3>")
+            report.write(f"<pre>{html.escape(entries[0]['code'])}</pre>")
+            # todo: show prompt but put it in a drop-down that you click to expand
+            report.write("<table>")
+            for entry in entries:
+                report.write(f"<tr><td><h3>{html_escape(entry['config'])}</h3><div>{html_escape(entry['text'])}</div></td></tr>")
+            report.write("</table>\n")
+        report.write("</div>")
+        report.write(REPORT_TAIL)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         prog='FeedBot batch tester'
     )
 
-    parser.add_argument('-s', '--submissions', required = True)
-    parser.add_argument('-c', '--configs', required = True)
-    parser.add_argument('-a', '--assignment', required = True)
-    parser.add_argument('-j', '--spec', required = True)
+    parser.add_argument('-s', '--submissions')
+    parser.add_argument('-c', '--configs')
+    parser.add_argument('-a', '--assignment')
+    parser.add_argument('-j', '--spec')
     parser.add_argument('-r', '--results', required = True)
     parser.add_argument('-p', '--problem', type=int)
     parser.add_argument('-n', '--count', type=int, default=3)
+    parser.add_argument('--rpm', type=int, default=500)
+    parser.add_argument('--tpm', type=int, default=200000)
+    parser.add_argument('--max-in-flight', type=int, default=32)
+    parser.add_argument('--jobs', type=int, default=4)
+    parser.add_argument('--report-only', action='store_true')
+    parser.add_argument('--archive', default = DEFAULT_ARCHIVE)
+    parser.add_argument('--trace', default = metrics.DEFAULT_TRACE_FILE)
 
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO)
-    batch_test(args.submissions, args.configs, args.results, args.assignment, args.spec, args.count, args.problem)
+    if args.trace:
+        metrics.enable(args.trace)
+
+    if args.report_only:
+        log_path = log_file_path(args.results)
+        if not os.path.exists(log_path):
+            parser.error(f"--report-only needs the results of an earlier run, but there is no {log_path}")
+        write_report(log_path, report_file_path(args.results), f"Report from {log_path}")
+        raise SystemExit(0)
+    if not (args.submissions and args.configs and args.assignment and args.spec):
+        parser.error("-s, -c, -a and -j are required unless --report-only is given")
+    batch_test(args.submissions, args.configs, args.results, args.assignment, args.spec, args.count, args.problem, RateLimiter(args.rpm, args.tpm, args.max_in_flight), RetryPolicy(), args.jobs, args.archive)
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from submission import SubmissionTemplate
+from assignment import AssignmentStatement
+from query import get_comment, get_prompt_segments
+from main import make_client
+from retry import RetryPolicy
+from ratelimit import RateLimiter
+from metrics import percentile
+
+DEFAULT_BASELINE = "benchmark-baseline.json"
+
+# Assignments shipped with the repo: (name, spec, template, submission)
+ASSIGNMENTS = [
+    ("example", "example/ex_spec.json", "example/ex_assign.rkt", "example/ex_submission.rkt"),
+    ("hw0", "hw0/spec.json", "hw0/template.rkt", "hw0/template.rkt"),
+    ("f24-hw3", "f24-hw3/spec.json", "f24-hw3/template.rkt", "f24-hw3/template.rkt"),
+]
+
+# A local stand-in for the OpenAI chat completions endpoint, with configurable
+# latency (lognormal around a median), error and rate-limit rates, and response size
+class MockOpenAIServer:
+    def __init__(self, median_latency=1.0, latency_sigma=0.5, error_rate=0.0, rate_limit_rate=0.0, response_words=200, seed=None):
+        self.median_latency = median_latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.response_words = response_words
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.first_request = None
+        self.httpd = None
+
+    def _roll(self):
+        with self.lock:
+            self.requests += 1
+            return self.random.random(), self.median_latency * self.random.lognormvariate(0, self.latency_sigma)
+
+    def completion(self, body):
+        words = " ".join(["hint"] * self.response_words)
+        prompt_tokens = sum(len(m["content"]) // 4 for m in body["messages"])
+        return {
+            "id": f"chatcmpl-mock{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [
+                {
+                    "index": i,
+                    "message": { "role": "assistant", "content": f"PART 1\n...\n======\n{words}" },
+                    "finish_reason": "stop"
+                }
+                for i in range(body.get("n", 1))
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": self.response_words,
+                "total_tokens": prompt_tokens + self.response_words,
+                "prompt_tokens_details": { "cached_tokens": 0 }
+            }
+        }
+
+    def start(self):
+        """
+        Starts serving on a free local port in a background thread. Returns the base URL for the OpenAI client
+
+        """
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, payload, headers={}):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                if server.first_request is None:
+                    server.first_request = time.perf_counter()
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                roll, latency = server._roll()
+                if roll < server.rate_limit_rate:
+                    self._reply(429, { "error": { "message": "Rate limit reached", "type": "requests" } }, { "retry-after-ms": "200" })
+                    return
+                time.sleep(latency)
+                if roll < server.rate_limit_rate + server.error_rate:
+                    self._reply(500, { "error": { "message": "Mock server error", "type": "server_error" } })
+                    return
+                if body.get("stream"):
+                    self._stream(server.completion(body))
+                else:
+                    self._reply(200, server.completion(body))
+
+            def _stream(self, completion):
+                # server-sent events, a few words per chunk, then the usage
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                base = { k: completion[k] for k in ["id", "created", "model"] }
+                base["object"] = "chat.completion.chunk"
+                words = completion["choices"][0]["message"]["content"].split(" ")
+                for i in range(0, len(words), 8):
+                    delta = " ".join(words[i:i + 8]) + (" " if i + 8 < len(words) else "")
+                    chunk = dict(base, choices=[{ "index": 0, "delta": { "content": delta }, "finish_reason": None }])
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                chunk = dict(base, choices=[], usage=completion["usage"])
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+                self.close_connection = True
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 1024
+
+            def handle_error(self, request, client_address):
+                # clients that hang up mid-request, like the cold-start runs, are expected
+                if not isinstance(sys.exc_info()[1], (ConnectionError, ValueError)):
+                    super().handle_error(request, client_address)
+
+        self.httpd = Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+# Writes a synthetic assignment with `problems` problems of `parts` parts each, and a roster of
+# `students` submissions of it, into folder. Returns (spec path, template path, submission paths)
+def generate_assignment(folder, problems, parts, students, seed=0):
+    rand = random.Random(seed)
+    filler = ";; Design a function that consumes a list of numbers and produces their sum, following the design recipe."
+    template_lines = ["#lang htdp/isl+", ""]
+    spec_problems = []
+    for p in range(1, problems + 1):
+        template_lines += [f";;! Problem {p}", ""] + [filler] * 4 + [""]
+        for q in range(parts):
+            part = f"Part {chr(ord('A') + q)}"
+            template_lines += [f";;! {part}", ""] + [filler] * 3 + ["", ";;!! Write your code below:", ""]
+            spec_problems.append({ "path": [f"Problem {p}", part], "tags": [rand.choice(["DD", "FD"])] })
+    spec = { "assignment": { "title": "Synthetic", "problems": spec_problems } }
+
+    spec_path = os.path.join(folder, "spec.json")
+    template_path = os.path.join(folder, "template.rkt")
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f)
+    with open(template_path, 'w') as f:
+        f.write("\n".join(template_lines) + "\n")
+
+    submission_paths = []
+    for s in range(students):
+        lines = []
+        for line in template_lines:
+            lines.append(line)
+            if line.startswith(";;!!") and rand.random() < 0.8:
+                lines += [f"(define (f{s}-{i} x) (+ x {rand.randint(0, 100)}))" for i in range(rand.randint(1, 20))]
+        submission_path = os.path.join(folder, f"student{s}.rkt")
+        with open(submission_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        submission_paths.append(submission_path)
+    return spec_path, template_path, submission_paths
+
+# Benchmarks one assignment: parse time, prompt-build time, and end-to-end grading of the roster
+# against the mock server
+def benchmark_assignment(name, spec_path, template_path, submission_paths, config, base_url, limiter, retry, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        assignment = AssignmentStatement.load(spec_path, template_path)
+        submissions = [SubmissionTemplate.load(path) for path in submission_paths]
+    parse_time = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    prompts = 0
+    for _ in range(repeat):
+        for submission in submissions:
+            for problem in assignment.problems:
+                get_prompt_segments(problem, submission.at(problem.path, True).contents(), assignment, config,
+                                    submission.extract_responses(problem.dependencies))
+                prompts += 1
+    prompt_time = (time.perf_counter() - start) / prompts
+
+    async def grade_roster():
+        client = make_client("benchmark", retry).with_options(base_url=base_url)
+        try:
+            return await asyncio.gather(*[get_comment(client, assignment, submission, config, None, None, limiter, retry) for submission in submissions])
+        finally:
+            await client.close()
+
+    start = time.perf_counter()
+    results = asyncio.run(grade_roster())
+    elapsed = time.perf_counter() - start
+
+    comments = [c for answer in results for c in answer]
+    latencies = [c["stats"]["latency"] for c in comments if "latency" in c["stats"]]
+    return {
+        "name": name,
+        "problems": len(assignment.problems),
+        "submissions": len(submissions),
+        "requests": len(comments),
+        "errors": sum(1 for c in comments if c["text"] == "ERROR"),
+        "parse_ms": parse_time * 1000,
+        "prompt_build_ms": prompt_time * 1000,
+        "requests_per_sec": len(comments) / elapsed if elapsed > 0 else 0.0,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+    }
+
+# Times fresh `python main.py` runs, as the Gradescope container makes them, on the example assignment:
+# until the starter check rejects a submission, until a dry run exits, and until the first request
+# reaches the mock server. Returns the median of each over `repeat` runs
+def benchmark_cold_start(folder, config_path, server, base_url, repeat):
+    root = os.path.dirname(os.path.abspath(__file__))
+    _, spec_path, template_path, submission_path = ASSIGNMENTS[0]
+    env = dict(os.environ, OPENAI_BASE_URL=base_url, OPENAI_KEY="benchmark")
+    env.pop("FEEDBOT_DAEMON_SOCKET", None)
+
+    with open(os.path.join(root, submission_path), 'r') as f:
+        lines = f.read().split("\n")
+    first_marker = next(i for i, line in enumerate(lines) if line.startswith(";;!"))
+    off_starter_path = os.path.join(folder, "off-starter.rkt")
+    with open(off_starter_path, 'w') as f:
+        f.write("\n".join(lines[:first_marker] + lines[first_marker + 1:]))
+
+    def command(submission, *tacks):
+        return [sys.executable, "main.py", "-j", spec_path, "-a", template_path, "-c", os.path.abspath(config_path),
+                "-s", submission, "-r", os.path.join(folder, "cold-start.json"), "--no-cache", *tacks]
+
+    def until_exit(args):
+        start = time.perf_counter()
+        subprocess.run(args, cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return time.perf_counter() - start
+
+    def until_first_request(args):
+        server.first_request = None
+        start = time.perf_counter()
+        process = subprocess.Popen(args, cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        while server.first_request is None and process.poll() is None:
+            time.sleep(0.001)
+        process.kill()
+        process.wait()
+        if server.first_request is None:
+            raise RuntimeError("main.py exited without sending a request")
+        return server.first_request - start
+
+    return {
+        "name": "cold-start",
+        "starter_fail_ms": percentile([until_exit(command(off_starter_path)) for _ in range(repeat)], 50) * 1000,
+        "dry_run_ms": percentile([until_exit(command(submission_path)) for _ in range(repeat)], 50) * 1000,
+        "first_request_ms": percentile([until_first_request(command(submission_path, "--disable-dry-run")) for _ in range(repeat)], 50) * 1000,
+    }
+
+# Metrics where lower is better; the rest (requests_per_sec) are higher-is-better
+LOWER_IS_BETTER = ["parse_ms", "prompt_build_ms", "p50_s", "p95_s", "p99_s", "starter_fail_ms", "dry_run_ms", "first_request_ms"]
+
+# Returns a list of regression messages for results that are more than `tolerance` worse than the baseline
+def compare_to_baseline(results, baseline, tolerance):
+    regressions = []
+    old_by_name = { r["name"]: r for r in baseline }
+    for new in results:
+        old = old_by_name.get(new["name"])
+        if old is None:
+            continue
+        for metric in LOWER_IS_BETTER + ["requests_per_sec"]:
+            if not old.get(metric):
+                continue
+            change = (new[metric] - old[metric]) / old[metric]
+            worse = change > tolerance if metric in LOWER_IS_BETTER else change < -tolerance
+            if worse:
+                regressions.append(f"{new['name']}: {metric} {old[metric]:.3f} -> {new[metric]:.3f} ({change:+.0%})")
+    return regressions
+
+def print_table(results, columns=["name", "problems", "submissions", "requests", "errors", "parse_ms", "prompt_build_ms", "requests_per_sec", "p50_s", "p95_s", "p99_s"]):
+    print(" ".join(f"{c:>16}" for c in columns))
+    for r in results:
+        print(" ".join(f"{r[c]:>16.3f}" if isinstance(r[c], float) else f"{r[c]:>16}" for c in columns))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='FeedBot offline benchmark'
+    )
+
+    parser.add_argument('-c', '--config', default = "config.json")
+    parser.add_argument('--latency', type=float, default=1.0, help="median mock response time, in seconds")
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help="lognormal spread of the mock response time")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--response-words', type=int, default=200)
+    parser.add_argument('--students', type=int, default=30, help="submissions in the synthetic roster")
+    parser.add_argument('--problems', type=int, default=10, help="problems in the synthetic assignment")
+    parser.add_argument('--parts', type=int, default=4, help="parts per problem in the synthetic assignment")
+    parser.add_argument('--repeat', type=int, default=5, help="repeats of the parse and prompt-build timings")
+    parser.add_argument('--max-in-flight', type=int, default=64)
+    parser.add_argument('--cold-starts', type=int, default=5, help="fresh main.py runs to time for the cold-start measurement (0 to skip it)")
+    parser.add_argument('--baseline', default = DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help="fractional change counted as a regression")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-d', '--debug', action='store_true')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.debug else logging.ERROR)
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+
+    server = MockOpenAIServer(args.latency, args.latency_sigma, args.error_rate, args.rate_limit_rate, args.response_words, args.seed)
+    base_url = server.start()
+    limiter = RateLimiter(max_in_flight=args.max_in_flight)
+    retry = RetryPolicy(timeout=max(30, args.latency * 20), base_delay=0.1)
+
+    folder = tempfile.mkdtemp(prefix="feedbot-bench-")
+    try:
+        workloads = [(name, spec, template, [submission]) for name, spec, template, submission in ASSIGNMENTS]
+        workloads.append(("synthetic", *generate_assignment(folder, args.problems, args.parts, args.students, args.seed)))
+
+        results = [benchmark_assignment(*workload, config, base_url, limiter, retry, args.repeat) for workload in workloads]
+        cold_start = [benchmark_cold_start(folder, args.config, server, base_url, args.cold_starts)] if args.cold_starts > 0 else []
+    finally:
+        server.stop()
+        shutil.rmtree(folder)
+
+    print_table(results)
+    if cold_start:
+        print()
+        print_table(cold_start, ["name", "starter_fail_ms", "dry_run_ms", "first_request_ms"])
+    results += cold_start
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions against baseline:")
+            print("\n".join(regressions))
+            raise SystemExit(1)
+        print("\nNo regressions against baseline")
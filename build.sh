@@ -6,6 +6,10 @@ TAG=$ASSIGNMENT-$TIMESTAMP
 mkdir -p source
 cp ../gradescope/run_autograder ../*.py ../requirements.txt ../key source
 cp template.rkt spec.json ../config.json source
+# precompute the starter template's fingerprint, for the starter check
+python3 source/starter_checker.py source/template.rkt
+# compile the assignment, so it is not re-parsed and re-validated on every run
+python3 source/assignment.py -j source/spec.json -a source/template.rkt
 docker build -t dbp1/cs2500f24:$TAG -f ../gradescope/Dockerfile .
 docker push dbp1/cs2500f24:$TAG
 rm -rf source
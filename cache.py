@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.environ.get("FEEDBOT_CACHE_DIR", ".feedbot-cache")
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL = 30 * 24 * 60 * 60
+# The whole directory is only scanned when the cache grows past max_bytes (it is then evicted down to
+# this fraction of it, so the next few puts do not scan again), or every SWEEP_EVERY puts, which also
+# catches entries added by other processes sharing the directory
+LOW_WATER = 0.9
+SWEEP_EVERY = 1000
+
+# An on-disk, content-addressed cache of model responses.
+# Each entry is one JSON file named by the hash of the full request (messages, model, sampling settings).
+# Reads refresh the file's mtime, so eviction (oldest mtime first) is least-recently-used,
+# and the TTL is idle time: an entry expires once it has gone unused for that long.
+# The directory is only created by the first put, so runs that never store a response leave no trace.
+class ResponseCache:
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.size = None    # bytes on disk, as of the last scan plus this process's puts since
+        self.puts = 0
+
+    @staticmethod
+    def key(request):
+        """
+        Returns the content hash for a request (any JSON-serializable dict)
+
+        """
+        encoded = json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, key):
+        """
+        Returns the cached response text for the key, or None if it is missing or expired
+
+        """
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, "r") as f:
+                last_used = os.fstat(f.fileno()).st_mtime
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        if self.ttl is not None and time.time() - last_used > self.ttl:
+            self._remove(entry_path)
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry["text"]
+
+    def put(self, key, text):
+        """
+        Stores the response text under the key, then evicts least-recently-used entries if the cache
+        has grown past the size bound
+
+        """
+        os.makedirs(self.path, exist_ok=True)
+        entry_path = self._entry_path(key)
+        tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"created": time.time(), "text": text}, f)
+        try:
+            replaced = os.path.getsize(entry_path)
+        except OSError:
+            replaced = 0
+        added = os.path.getsize(tmp_path) - replaced
+        os.replace(tmp_path, entry_path)
+
+        self.puts += 1
+        if self.size is not None:
+            self.size += added
+        if self.size is None or self.puts % SWEEP_EVERY == 0 or (self.max_bytes is not None and self.size > self.max_bytes):
+            self.evict()
+
+    def evict(self):
+        """
+        Removes expired (unused for longer than the TTL) entries, then, if the cache does not fit in
+        max_bytes, the least recently used ones until it fits in LOW_WATER of it
+
+        """
+        now = time.time()
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            entry_path = os.path.join(self.path, name)
+            try:
+                st = os.stat(entry_path)
+            except OSError:
+                continue
+            if self.ttl is not None and now - st.st_mtime > self.ttl:
+                self._remove(entry_path)
+                continue
+            entries.append((st.st_mtime, st.st_size, entry_path))
+            total += st.st_size
+
+        if self.max_bytes is not None and total > self.max_bytes:
+            for _, size, entry_path in sorted(entries):
+                self._remove(entry_path)
+                total -= size
+                if total <= self.max_bytes * LOW_WATER:
+                    break
+        self.size = total
+
+    def _remove(self, entry_path):
+        try:
+            os.remove(entry_path)
+        except OSError:
+            logger.warning(f"Could not remove cache entry {entry_path}")
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import os
+import io
+import logging
+logger = logging.getLogger(__name__)
+
+from starter_checker import follows_starter, StarterFingerprint
+from submission import SubmissionTemplate
+from assignment import AssignmentStatement
+from cache import ResponseCache, DEFAULT_CACHE_DIR
+from ratelimit import RateLimiter
+from retry import RetryPolicy
+from main import grade, make_client
+from poster import ResultPoster, DEFAULT_SPOOL_DIR
+from history import SubmissionHistory
+from archive import FeedbackArchive
+import metrics
+from query import get_tokenizer
+
+from dotenv import load_dotenv
+load_dotenv()
+
+DEFAULT_SOCKET = "/tmp/feedbot.sock"
+
+# A long-lived grading service. Keeps one OpenAI client and one ResultPoster (and their connection pools), the tokenizers,
+# and every parsed assignment and config warm, and grades submissions sent by main.py --daemon.
+# Assignments and configs are reloaded when their files change on disk.
+class GradingDaemon:
+    def __init__(self, cache=None, limiter=None, retry=None, poster=None):
+        self.cache = cache
+        self.limiter = limiter
+        self.retry = retry
+        self.poster = poster if poster is not None else ResultPoster()
+        self.client = make_client(os.environ["OPENAI_KEY"], retry)
+        self.assignments = {}
+        self.configs = {}
+        self.archives = {}
+
+    @staticmethod
+    def _load(store, paths, loader):
+        mtimes = tuple(os.path.getmtime(p) for p in paths)
+        entry = store.get(paths)
+        if entry is None or entry[0] != mtimes:
+            entry = (mtimes, loader())
+            store[paths] = entry
+        return entry[1]
+
+    def assignment(self, spec_path, template_path):
+        """
+        Returns the parsed assignment, parsing it only if it is new or has changed
+
+        """
+        return self._load(self.assignments, (spec_path, template_path), lambda: AssignmentStatement.load(spec_path, template_path))
+
+    def config(self, config_path):
+        """
+        Returns the parsed config, parsing it (and loading its model's tokenizer) only if it is new or has changed
+
+        """
+        def load():
+            with open(config_path, 'r') as f:
+                config = json.load(f)
+            try:
+                get_tokenizer(config["model"])
+            except Exception:
+                logger.warning(f"Could not load the tokenizer for {config['model']} ahead of time")
+            return config
+        return self._load(self.configs, (config_path,), load)
+
+    def archive(self, archive_path):
+        """
+        Returns the FeedbackArchive at the path, opening it only once
+
+        """
+        if archive_path not in self.archives:
+            self.archives[archive_path] = FeedbackArchive(archive_path)
+        return self.archives[archive_path]
+
+    def close(self):
+        """
+        Closes the archives this daemon has opened
+
+        """
+        for archive in self.archives.values():
+            archive.close()
+        self.archives = {}
+
+    async def handle(self, request):
+        """
+        Grades one submission, as main.process would. Returns (exit code, output)
+
+        """
+        logger.info("\n\nprocessing submission {} with assignment {} and config {}\n".format(request["submission"], request["assignment"], request["config"]))
+        config = self.config(request["config"])
+
+        submission = SubmissionTemplate.load(request["submission"])
+        output_lines = []
+        if not follows_starter(output_lines, submission, StarterFingerprint.load(request["assignment"])):
+            return 42, "\n".join(output_lines) + "\n"
+
+        assignment = self.assignment(request["spec"], request["assignment"])
+        if not request["disable_dry_run"]:
+            return 0, "dummy.url.io\n"
+
+        history = SubmissionHistory(request["history"]) if request.get("history") else None
+        archive = self.archive(request["archive"]) if request.get("archive") else None
+        out = io.StringIO()
+        await grade(self.client, assignment, request["submission"], config, request["problem"], request["url"], request["result"],
+                    request["email"], request["key"], self.cache, self.limiter, self.retry, out, request.get("incremental", False), self.poster, history, submission, archive)
+        return 0, out.getvalue()
+
+    async def _on_connection(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            try:
+                exit_code, output = await self.handle(request)
+            except Exception:
+                logger.exception('')
+                exit_code, output = 1, ""
+            writer.write(json.dumps({ "exit_code": exit_code, "output": output }).encode("utf-8") + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(self._on_connection, path=socket_path)
+        logger.info(f"FeedBot grading daemon listening on {socket_path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='FeedBot grading daemon'
+    )
+
+    parser.add_argument('--socket', default = os.environ.get("FEEDBOT_DAEMON_SOCKET", DEFAULT_SOCKET))
+    parser.add_argument('-a', '--assignment')
+    parser.add_argument('-j', '--spec')
+    parser.add_argument('-c', '--config')
+    parser.add_argument('-d', '--debug', action='store_true')
+    parser.add_argument('--cache-dir', default = DEFAULT_CACHE_DIR)
+    parser.add_argument('--cache-max-mb', type=int, default = 64)
+    parser.add_argument('--cache-ttl-days', type=float, default = 30)
+    parser.add_argument('--no-cache', action = "store_true", default = False)
+    parser.add_argument('--rpm', type=int)
+    parser.add_argument('--tpm', type=int)
+    parser.add_argument('--max-in-flight', type=int)
+    parser.add_argument('--timeout', type=float, default = 120)
+    parser.add_argument('--max-attempts', type=int, default = 3)
+    parser.add_argument('--hedge-after', type=float)
+    parser.add_argument('--spool-dir', default = DEFAULT_SPOOL_DIR)
+    parser.add_argument('--gzip', action = "store_true", default = False)
+    parser.add_argument('--trace', default = metrics.DEFAULT_TRACE_FILE)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.debug else logging.WARNING)
+    if args.trace:
+        metrics.enable(args.trace)
+
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_dir, args.cache_max_mb * 1024 * 1024, args.cache_ttl_days * 24 * 60 * 60)
+
+    limiter = None
+    if args.rpm or args.tpm or args.max_in_flight:
+        limiter = RateLimiter(args.rpm, args.tpm, args.max_in_flight)
+
+    daemon = GradingDaemon(cache, limiter, RetryPolicy(args.timeout, args.max_attempts, hedge_after=args.hedge_after),
+                           ResultPoster(args.spool_dir, compress=args.gzip))
+
+    # optionally warm up an assignment and config before the first submission arrives
+    if args.config:
+        daemon.config(os.path.abspath(args.config))
+    if args.spec and args.assignment:
+        daemon.assignment(os.path.abspath(args.spec), os.path.abspath(args.assignment))
+
+    asyncio.run(daemon.serve(args.socket))
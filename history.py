@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_HISTORY_DIR = os.environ.get("FEEDBOT_HISTORY_DIR")
+
+# Per-student records of the last graded submission of an assignment: for each problem, a fingerprint
+# of everything its comment depended on (the problem, the config, and the student's normalized code and
+# dependency code) and the comment itself. On a resubmission, only problems whose fingerprint changed
+# need a new comment; the rest carry their previous comment forward, even if other parts of the file changed.
+class SubmissionHistory:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _record_path(self, assignment, student):
+        name = hashlib.sha256(json.dumps([assignment.title, student]).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, name + ".json")
+
+    def load(self, assignment, student):
+        """
+        Returns the problems of a student's last graded submission of the assignment,
+        as a dict from problem path to { "fingerprint", "comment" }, or {} if there is none
+
+        """
+        try:
+            with open(self._record_path(assignment, student), 'r') as f:
+                return json.load(f)["problems"]
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def save(self, assignment, student, fingerprints, comments):
+        """
+        Records a student's graded submission: the fingerprint and comment of each problem.
+        Problems that were not graded this time keep their previous record; errors are not recorded
+
+        """
+        problems = self.load(assignment, student)
+        for comment in comments:
+            if comment["text"] != "ERROR":
+                problems[comment["path"]] = { "fingerprint": fingerprints[comment["path"]], "comment": comment }
+        record_path = self._record_path(assignment, student)
+        tmp = record_path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({ "assignment": assignment.title, "student": student, "problems": problems }, f)
+        os.replace(tmp, record_path)
+
+    def reusable(self, assignment, submission, config, student, prob=None):
+        """
+        Diffs a submission against the student's record. Returns the fingerprint of every problem
+        (by path) and the comments that can be carried forward (by problem index)
+
+        """
+        from query import render_path
+
+        record = self.load(assignment, student)
+        indices = range(len(assignment.problems)) if prob is None else [prob]
+        fingerprints = {}
+        reuse = {}
+        for i in indices:
+            problem = assignment.problems[i]
+            path = render_path(problem.path)
+            fingerprints[path] = problem_fingerprint(problem, submission, config)
+            previous = record.get(path)
+            if previous is not None and previous["fingerprint"] == fingerprints[path]:
+                comment = dict(previous["comment"])
+                comment["code"] = submission.response(problem.path)
+                comment["stats"] = { "reused": True }
+                reuse[i] = comment
+        logger.info(f"\n--------------------------------------------\n REUSED: {len(reuse)} of {len(fingerprints)} comments from the last submission\n--------------------------------------------\n")
+        return fingerprints, reuse
+
+# Returns a hash of everything a problem's comment depends on: the problem and its context, the config,
+# and the student's code for it and for its dependencies (normalized, so whitespace-only edits do not count)
+# (ProblemStatement, SubmissionTemplate, dict) -> str
+def problem_fingerprint(problem, submission, config):
+    from query import normalize_response
+
+    inputs = {
+        "config": config,
+        "path": problem.path,
+        "context": problem.context,
+        "statement": problem.statement,
+        "tags": problem.tags,
+        "grading_note": problem.grading_note,
+        "dependencies": problem.dependencies,
+        "has_data": submission.at(problem.path, False).has_data(),
+        "code": normalize_response(submission.response(problem.path)),
+        "dependencies_code": normalize_response(submission.extract_responses(problem.dependencies)),
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
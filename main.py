@@ -3,17 +3,24 @@
 import argparse
 import asyncio
 import json
-import requests
-from openai import AsyncOpenAI
 import os
+import socket
 import sys
+import uuid
 import logging
 logger = logging.getLogger(__name__)
 
-from starter_checker import submission_uses_starter
+from starter_checker import follows_starter, StarterFingerprint
 from submission import SubmissionTemplate
 from assignment import ProblemStatement, AssignmentStatement
-from query import get_comment
+from cache import ResponseCache, DEFAULT_CACHE_DIR
+from ratelimit import RateLimiter
+from retry import RetryPolicy
+from poster import ResultPoster, DEFAULT_SPOOL_DIR
+from history import SubmissionHistory, DEFAULT_HISTORY_DIR
+from archive import FeedbackArchive, DEFAULT_ARCHIVE
+import metrics
+from metrics import span
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -27,20 +34,28 @@ def process(assignment_spec_path,
             results_path,
             submitter_email,
             post_key,
-            disable_dry_run):
+            disable_dry_run,
+            cache=None,
+            limiter=None,
+            retry=None,
+            incremental=False,
+            poster=None,
+            history=None,
+            archive=None):
     logger.info("\n\nprocessing submission {} with assignment {} and config {}\n".format(submission_path,assignment_template_path,config_path))
 
     with open(config_path, 'r') as config:
         key = os.environ["OPENAI_KEY"]
         config = json.load(config)
 
+        # the submission is parsed once, for the starter check and for grading
+        submission = SubmissionTemplate.load(submission_path)
         output_lines = []
-        if not submission_uses_starter(output_lines, submission_path, assignment_template_path):
+        if not follows_starter(output_lines, submission, StarterFingerprint.load(assignment_template_path)):
             print("\n".join(output_lines)) 
             sys.exit(42) # TODO: Verify this error code can't come from other places.
 
         assignment = AssignmentStatement.load(assignment_spec_path, assignment_template_path)
-        submission = SubmissionTemplate.load(submission_path)
         #subdata = slice_submission(submission_path)
         #if not subdata.has_all_problems(range(len(assignment.problems))):
         #    raise InvalidSubmission("Submission does not have all problems", -1)
@@ -48,46 +63,186 @@ def process(assignment_spec_path,
             dummy_url = "dummy.url.io"
             print(dummy_url)
             return
-        client = AsyncOpenAI(api_key=key)
-        answer = asyncio.run(get_comment(client, assignment, submission, config, problem_number))
+        client = make_client(key, retry)
+        asyncio.run(closing(poster, grade(client, assignment, submission_path, config, problem_number, post_url, results_path, submitter_email, post_key, cache, limiter, retry, None, incremental, poster, history, submission, archive)))
+
+# Grades a folder or archive of submissions at once through the OpenAI Batch API (or a local stand-in
+# for it, which sends the requests right away), saving each submission's comments in results_folder_path
+# Without disable_dry_run, only the batch file is written. With resume, the batch saved in the results
+# folder is polled again instead of submitting a new one
+def process_batch(assignment_spec_path,
+                  assignment_template_path,
+                  submissions_path,
+                  config_path,
+                  problem_number,
+                  post_url,
+                  results_folder_path,
+                  post_key,
+                  emails,
+                  local,
+                  poll_interval,
+                  disable_dry_run,
+                  limiter=None,
+                  retry=None,
+                  poster=None,
+                  archive=None,
+                  resume=False):
+    from batch import grade_batch, OpenAIBatchBackend, LocalBatchBackend
+
+    with open(config_path, 'r') as config:
+        config = json.load(config)
+    assignment = AssignmentStatement.load(assignment_spec_path, assignment_template_path)
+    client = make_client(os.environ["OPENAI_KEY"], retry)
+    backend = LocalBatchBackend(client, limiter, retry) if local else OpenAIBatchBackend(client)
+    asyncio.run(closing(poster, grade_batch(backend, assignment, assignment_template_path, submissions_path, config, problem_number,
+                                            results_folder_path, post_url, post_key, emails, poll_interval, not disable_dry_run, poster, archive, resume)))
+
+# Awaits a grading coroutine, then closes the connections the poster opened on this event loop,
+# which goes away when asyncio.run returns
+async def closing(poster, graded):
+    try:
+        return await graded
+    finally:
+        if poster is not None:
+            await poster.close()
+
+# Makes the OpenAI client. Retries are handled by the RetryPolicy, if there is one
+# (str, RetryPolicy) -> AsyncOpenAI
+def make_client(key, retry=None):
+    from openai import AsyncOpenAI
+    if retry is None:
+        return AsyncOpenAI(api_key=key)
+    return AsyncOpenAI(api_key=key, max_retries=0)
+
+# Gets feedback on a submission of an already loaded assignment, then prints, posts and/or saves it
+# Output meant for the user is printed to out (stdout if None)
+# If incremental, each problem's comment is also posted as soon as it is ready (see post_each_comment)
+# Posts go through the given ResultPoster, or a new one that is closed afterwards
+# If a SubmissionHistory is given (and the submitter's email is known), only problems whose code or
+# dependencies' code changed since the submitter's last submission are graded; the rest keep their comments
+# submission is the already parsed submission at submission_path, if the caller has it
+# If a FeedbackArchive is given, the comments are also added to it
+async def grade(client, assignment, submission_path, config, problem_number, post_url, results_path, submitter_email, post_key, cache=None, limiter=None, retry=None, out=None, incremental=False, poster=None, history=None, submission=None, archive=None):
+    if post_url and poster is None:
+        poster = ResultPoster()
+        try:
+            return await grade(client, assignment, submission_path, config, problem_number, post_url, results_path, submitter_email, post_key,
+                               cache, limiter, retry, out, incremental, poster, history, submission, archive)
+        finally:
+            await poster.close()
+
+    from query import get_comment
+
+    with span("grade", assignment=assignment.title, submission=submission_path):
+        if submission is None:
+            submission = SubmissionTemplate.load(submission_path)
+        reuse = None
+        if history is not None and submitter_email:
+            fingerprints, reuse = history.reusable(assignment, submission, config, submitter_email, problem_number)
+
+        entry = None
+        if post_url and incremental:
+            entry = uuid.uuid4().hex
+            answer = await post_each_comment(client, assignment, submission, config, problem_number, post_url, post_key, submitter_email, entry, poster, cache, limiter, retry, reuse)
+        else:
+            answer = await get_comment(client, assignment, submission, config, problem_number, cache, limiter, retry, reuse)
         output = {}
 
+        if reuse is not None:
+            history.save(assignment, submitter_email, fingerprints, answer)
+
         if results_path:
             output = answer
         elif not post_url:
-            print("\n\n\n\nModel Output:")
+            print("\n\n\n\nModel Output:", file=out)
             for part in answer:
-                print(f"\n\n=============================\n")
+                print(f"\n\n=============================\n", file=out)
                 path = part['path'].split(", ")
-                print(f"{submission_path}: {'=>'.join(path)}\n")
-                print(part['code'])
-                print(f"\n~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n")
-                print(part['text'])
-                print(f"\n=============================\n\n")
+                print(f"{submission_path}: {'=>'.join(path)}\n", file=out)
+                print(part['code'], file=out)
+                print(f"\n~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n", file=out)
+                print(part['text'], file=out)
+                print(f"\n=============================\n\n", file=out)
 
 
         if post_url:
-            response = send_request(
+            response = await send_request(
+                poster,
                 post_url,
                 post_key,
                 answer,
-                submitter_email
+                submitter_email,
+                entry
             )
-            if response.status_code == 200:
+            if response is None:
+                logger.error("Did not post successfully, saved the comments to be posted later")
+            elif response.status_code == 200:
                 url = post_url + "/submission/" + json.loads(response.text)['msg'][4:]
                 output["output"] = f"Feedbot automated feedback available at [{url}]({url})."
                 output["output_format"] = "md"
-                print(url)
+                print(url, file=out)
             else:
                 logger.error("Did not post successfully: " + response.text)
-        
+    
         if results_path:
             with open(results_path, 'w') as results_file:
                 json.dump(output, results_file)
 
-# Sends a POST request to the given URL, using the given list of comments
-# (str (URL), List[Comment], str (Email)) -> Response
-def send_request(url, key, comments, submitter_email):
+        # archived only once the comments are delivered, so a failing archive cannot hold them up
+        if archive is not None:
+            try:
+                archive.record(assignment, config, answer, submission_path, submitter_email)
+            except Exception:
+                logger.exception("Could not add the comments to the archive")
+
+# Gets feedback on a submission like get_comment, but posts each problem's comment to the server's
+# incremental endpoint (see send_comment) as soon as it and the comments on the problems it depends on
+# are ready (see stream_comments), so students see the first feedback while the slower problems are
+# still being graded, and a slow problem only holds back the posts on problems that depend on it. The posts are made
+# while grading goes on; a failed one is only logged, since the full entry is posted at the end.
+# Returns the comments in problem order
+async def post_each_comment(client, assignment, submission, config, problem_number, post_url, post_key, submitter_email, entry, poster, cache=None, limiter=None, retry=None, reuse=None):
+    from query import stream_comments
+
+    total = len(assignment.problems) if problem_number is None else 1
+    comments = []
+    posts = []
+    async for i, comment in stream_comments(client, assignment, submission, config, problem_number, cache, limiter, retry, reuse):
+        comments.append((i, comment))
+        posts.append(asyncio.create_task(send_comment(poster, post_url, post_key, entry, i, total, comment, submitter_email)))
+
+    for i, response in zip([i for i, _ in comments], await asyncio.gather(*posts, return_exceptions=True)):
+        if response is None:
+            logger.error(f"Did not post the comment on problem {i}, saved it to be posted later")
+        elif isinstance(response, Exception):
+            logger.error(f"Did not post the comment on problem {i}: {response}")
+        elif response.status_code != 200:
+            logger.error(f"Did not post the comment on problem {i}: " + response.text)
+    return [comment for _, comment in sorted(comments, key=lambda c: c[0])]
+
+# Forwards a grading request to a running grading daemon (see daemon.py) over its Unix socket
+# Returns (exit code, output), or None if no daemon is listening there
+# (str, dict) -> (int, str) | None
+def submit_to_daemon(socket_path, request):
+    if not os.path.exists(socket_path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            sock.shutdown(socket.SHUT_WR)
+            with sock.makefile("rb") as f:
+                reply = json.loads(f.readline())
+    except (OSError, ValueError):
+        logger.warning(f"No grading daemon at {socket_path}, running in-process")
+        return None
+    return reply["exit_code"], reply["output"]
+
+# Sends a POST request to the given URL, using the given list of comments, through a ResultPoster.
+# entry is the id its comments were already posted under one at a time (see send_comment), if they were
+# Returns None if the post could not be delivered and was spooled to be sent later
+# (ResultPoster, str (URL), str, List[Comment], str (Email), str) -> Response | None
+async def send_request(poster, url, key, comments, submitter_email, entry=None):
     addendum = 'entry'
 
     request_obj = {
@@ -98,8 +253,28 @@ def send_request(url, key, comments, submitter_email):
         'email': submitter_email,
         'key': key
     }
+    if entry is not None:
+        request_obj['entry'] = entry
 
-    return requests.post(url + "/" + addendum, json=request_obj)
+    return await poster.post(url + "/" + addendum, request_obj)
+
+# Posts one problem's comment to the FeedBot server's incremental endpoint, under the entry id
+# that the submission's later full post (see send_request) will carry. index is the problem's
+# position in the assignment and total the number of comments the entry will have
+# (ResultPoster, str (URL), str, str, int, int, Comment, str (Email)) -> Response | None
+async def send_comment(poster, url, key, entry, index, total, comment, submitter_email):
+    addendum = 'entry/partial'
+
+    request_obj = {
+        'entry': entry,
+        'index': index,
+        'total': total,
+        'comment': comment,
+        'email': submitter_email,
+        'key': key
+    }
+
+    return await poster.post(url + "/" + addendum, request_obj)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -107,7 +282,7 @@ if __name__ == "__main__":
     )
 
     parser.add_argument('-u', '--url')
-    parser.add_argument('-s', '--submission', required = True)
+    parser.add_argument('-s', '--submission')
     parser.add_argument('-a', '--assignment', required = True)
     parser.add_argument('-j', '--spec', required = True)
     parser.add_argument('-c', '--config', default = "config.json")
@@ -117,10 +292,83 @@ if __name__ == "__main__":
     parser.add_argument('-e', '--email', default = "")
     parser.add_argument('-k', '--key', default = os.environ.get("FEEDBOT_KEY",""))
     parser.add_argument('--disable-dry-run', action = "store_true", default = False)
+    parser.add_argument('--post-incremental', action = "store_true", default = False)
+    parser.add_argument('--spool-dir', default = DEFAULT_SPOOL_DIR)
+    parser.add_argument('--gzip', action = "store_true", default = False)
+    parser.add_argument('--history', default = DEFAULT_HISTORY_DIR)
+    parser.add_argument('--archive', default = DEFAULT_ARCHIVE)
+    parser.add_argument('--trace', default = metrics.DEFAULT_TRACE_FILE)
+    parser.add_argument('--cache-dir', default = DEFAULT_CACHE_DIR)
+    parser.add_argument('--cache-max-mb', type=int, default = 64)
+    parser.add_argument('--cache-ttl-days', type=float, default = 30)
+    parser.add_argument('--no-cache', action = "store_true", default = False)
+    parser.add_argument('--rpm', type=int)
+    parser.add_argument('--tpm', type=int)
+    parser.add_argument('--max-in-flight', type=int)
+    parser.add_argument('--timeout', type=float, default = 120)
+    parser.add_argument('--max-attempts', type=int, default = 3)
+    parser.add_argument('--hedge-after', type=float)
+    parser.add_argument('--daemon', default = os.environ.get("FEEDBOT_DAEMON_SOCKET"))
+    parser.add_argument('--batch')
+    parser.add_argument('--batch-emails')
+    parser.add_argument('--local-batch', action = "store_true", default = False)
+    parser.add_argument('--poll-interval', type=float, default = 60)
+    parser.add_argument('--resume-batch', action = "store_true", default = False)
 
     args = parser.parse_args()
 
     if args.debug:
         logging.basicConfig(level=logging.INFO)
 
-    process(args.spec, args.assignment, args.submission, args.config, args.problem, args.url, args.result, args.email, args.key, args.disable_dry_run)
+    if args.trace:
+        metrics.enable(args.trace)
+
+    if args.batch:
+        if not args.result:
+            parser.error("--batch needs a results folder (-r)")
+    elif not args.submission:
+        parser.error("the following arguments are required: -s/--submission")
+
+    if args.daemon and not args.batch:
+        paths = { name: os.path.abspath(getattr(args, name)) if getattr(args, name) else None
+                  for name in ["spec", "assignment", "submission", "config", "result"] }
+        request = dict(paths, problem=args.problem, url=args.url, email=args.email, key=args.key, disable_dry_run=args.disable_dry_run,
+                       incremental=args.post_incremental, history=os.path.abspath(args.history) if args.history else None,
+                       archive=os.path.abspath(args.archive) if args.archive else None)
+        reply = submit_to_daemon(args.daemon, request)
+        if reply is not None:
+            exit_code, output = reply
+            if output:
+                print(output, end="")
+            sys.exit(exit_code)
+
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_dir, args.cache_max_mb * 1024 * 1024, args.cache_ttl_days * 24 * 60 * 60)
+
+    limiter = None
+    if args.rpm or args.tpm or args.max_in_flight:
+        limiter = RateLimiter(args.rpm, args.tpm, args.max_in_flight)
+
+    retry = RetryPolicy(args.timeout, args.max_attempts, hedge_after=args.hedge_after)
+
+    poster = ResultPoster(args.spool_dir, compress=args.gzip)
+
+    history = SubmissionHistory(args.history) if args.history else None
+
+    archive = FeedbackArchive(args.archive) if args.archive else None
+
+    try:
+        if args.batch:
+            emails = {}
+            if args.batch_emails:
+                with open(args.batch_emails, 'r') as f:
+                    emails = json.load(f)
+            process_batch(args.spec, args.assignment, args.batch, args.config, args.problem, args.url, args.result, args.key, emails, args.local_batch, args.poll_interval, args.disable_dry_run, limiter, retry, poster, archive, args.resume_batch)
+            sys.exit(0)
+
+        with span("process", submission=args.submission):
+            process(args.spec, args.assignment, args.submission, args.config, args.problem, args.url, args.result, args.email, args.key, args.disable_dry_run, cache, limiter, retry, args.post_incremental, poster, history, archive)
+    finally:
+        if archive is not None:
+            archive.close()
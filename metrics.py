@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import contextvars
+import json
+import os
+import socket
+import time
+import uuid
+
+DEFAULT_TRACE_FILE = os.environ.get("FEEDBOT_TRACE")
+
+# Span attributes that every span nested inside one carrying them inherits, so spans can be grouped
+INHERITED = ("assignment", "submission", "problem", "tags")
+
+# The innermost open span of the running task: { "trace", "span", "inherited" }
+_current = contextvars.ContextVar("feedbot_span", default=None)
+_out = None
+_host = None
+
+# Starts writing spans, as JSON lines, to the given file (appending, so several processes or
+# containers can share one file). Until this is called, span() does nothing
+# str -> None
+def enable(path):
+    global _out, _host
+    _out = open(path, 'a', buffering=1, encoding="utf-8")
+    _host = f"{socket.gethostname()}:{os.getpid()}"
+
+def enabled():
+    return _out is not None
+
+# Times the enclosed block as a span named name, nested in the span that is open around it (also
+# across asyncio tasks, which inherit it). Yields the span's attribute dict, which the block may add to.
+# Each span is written as one JSON line: trace and span ids, parent span id, name, start (epoch
+# seconds), duration (seconds), attributes, and the exception type if the block raised one.
+@contextlib.contextmanager
+def span(name, **attrs):
+    if _out is None:
+        yield attrs
+        return
+
+    parent = _current.get()
+    trace = parent["trace"] if parent is not None else uuid.uuid4().hex
+    inherited = dict(parent["inherited"]) if parent is not None else {}
+    inherited.update({ k: attrs[k] for k in INHERITED if k in attrs })
+    span_id = uuid.uuid4().hex[:16]
+    token = _current.set({ "trace": trace, "span": span_id, "inherited": inherited })
+
+    start_time = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        _current.reset(token)
+        record = {
+            "trace": trace,
+            "span": span_id,
+            "parent": parent["span"] if parent is not None else None,
+            "name": name,
+            "host": _host,
+            "start": start_time,
+            "duration": duration,
+            "attrs": dict(inherited, **attrs)
+        }
+        if error is not None:
+            record["error"] = error
+        _out.write(json.dumps(record, default=str) + "\n")
+
+# Returns the p-th percentile of a list of numbers
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+# Token and timing attributes of spans that are summed (tokens, attempts) or averaged (times)
+SUMMED = ["input_tokens", "prompt_tokens", "cached_tokens", "completion_tokens", "attempts", "hedged", "cache_hit", "escalated", "unstarted"]
+AVERAGED = ["queue_wait", "ttft"]
+
+# Reads a trace file and returns one summary row per (group, span name, model): count, errors, total,
+# mean, p50 and p95 duration, the sums of SUMMED and the means of AVERAGED attributes, and the
+# escalation rate of cascade tiers. Spans are grouped by the given inherited attribute
+# (e.g. "assignment"), or not at all if by is None
+# (str, str) -> list[dict]
+def summarize(path, by="assignment"):
+    groups = {}
+    with open(path, 'r', encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            group = record["attrs"].get(by, "") if by is not None else ""
+            groups.setdefault((str(group), record["name"], str(record["attrs"].get("model", ""))), []).append(record)
+
+    rows = []
+    for (group, name, model), records in sorted(groups.items()):
+        durations = [r["duration"] for r in records]
+        row = {
+            "group": group,
+            "span": name,
+            "model": model,
+            "count": len(records),
+            "errors": sum(1 for r in records if "error" in r),
+            "total_s": sum(durations),
+            "mean_ms": sum(durations) / len(durations) * 1000,
+            "p50_ms": percentile(durations, 50) * 1000,
+            "p95_ms": percentile(durations, 95) * 1000,
+        }
+        for attr in SUMMED:
+            values = [r["attrs"][attr] for r in records if isinstance(r["attrs"].get(attr), (int, float))]
+            if values:
+                row[attr] = sum(values)
+        for attr in AVERAGED:
+            values = [r["attrs"][attr] for r in records if isinstance(r["attrs"].get(attr), (int, float))]
+            if values:
+                row[attr + "_ms"] = sum(values) / len(values) * 1000
+        if "escalated" in row:
+            row["escalation_rate"] = row["escalated"] / len(records)
+        rows.append(row)
+    return rows
+
+def print_table(rows):
+    columns = ["group", "span", "model", "count", "errors", "total_s", "mean_ms", "p50_ms", "p95_ms"]
+    columns += [c for c in SUMMED + ["escalation_rate"] + [a + "_ms" for a in AVERAGED] if any(c in r for r in rows)]
+    width = max([len("group")] + [len(r["group"]) for r in rows])
+    print(" ".join(f"{c:>{width}}" if c == "group" else f"{c:>17}" for c in columns))
+    for r in rows:
+        cells = []
+        for c in columns:
+            value = r.get(c, "")
+            if c == "group":
+                cells.append(f"{value:>{width}}")
+            elif isinstance(value, float):
+                cells.append(f"{value:>17.3f}")
+            else:
+                cells.append(f"{value:>17}")
+        print(" ".join(cells))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='FeedBot trace summary'
+    )
+
+    parser.add_argument('trace', nargs='?', default = DEFAULT_TRACE_FILE)
+    parser.add_argument('--by', default = "assignment", help="inherited attribute to group spans by (assignment, submission, problem, tags), or none")
+    parser.add_argument('--json', action='store_true', help="print the summary rows as JSON instead of a table")
+
+    args = parser.parse_args()
+
+    if args.trace is None:
+        parser.error("no trace file given (or set in FEEDBOT_TRACE)")
+
+    rows = summarize(args.trace, None if args.by == "none" else args.by)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(rows)
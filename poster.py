@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import time
+import uuid
+import logging
+logger = logging.getLogger(__name__)
+
+from retry import RetryPolicy
+from metrics import span
+
+DEFAULT_SPOOL_DIR = os.environ.get("FEEDBOT_SPOOL_DIR", ".feedbot-spool")
+REJECTED = "rejected"
+
+# Posts results to the FeedBot server over a pooled, keep-alive HTTP connection, optionally with
+# gzip-compressed bodies. Each payload gets an idempotency key, so the server can drop a retried post it already has.
+# Timed out, rate limited and failed posts are retried under a RetryPolicy; a payload that still
+# cannot be delivered is written to a spool directory, to be sent later by flush().
+class ResultPoster:
+    def __init__(self, spool_dir=DEFAULT_SPOOL_DIR, retry=None, compress=False):
+        self.spool_dir = spool_dir
+        self.retry = retry if retry is not None else RetryPolicy(timeout=30, max_attempts=4, base_delay=0.5, max_delay=10)
+        self.compress = compress
+        self.clients = {}
+
+    def _client(self):
+        # httpx connections belong to the event loop they were opened on
+        import httpx
+        loop = asyncio.get_running_loop()
+        client = self.clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(timeout=self.retry.timeout,
+                                       limits=httpx.Limits(max_connections=32, max_keepalive_connections=8))
+            self.clients[loop] = client
+        return client
+
+    async def close(self):
+        """
+        Closes the connections opened on the running event loop
+
+        """
+        client = self.clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    async def _send(self, url, body, idempotency_key):
+        data = json.dumps(body).encode("utf-8")
+        headers = { "Content-Type": "application/json", "Idempotency-Key": idempotency_key }
+        if self.compress:
+            response = await self._client().post(url, content=gzip.compress(data), headers=dict(headers, **{ "Content-Encoding": "gzip" }))
+            if response.status_code not in (400, 415):
+                return response
+            # the server does not take compressed bodies (Flask, for one, answers 400 to them)
+            logger.warning(f"{url} does not accept gzip-compressed posts, sending them uncompressed")
+            self.compress = False
+        return await self._client().post(url, content=data, headers=headers)
+
+    async def _deliver(self, url, body, idempotency_key):
+        async def attempt():
+            response = await self._send(url, body, idempotency_key)
+            if self.retry.is_retryable_status(response.status_code):
+                response.raise_for_status()
+            return response
+
+        with span("post", url=url) as attrs:
+            stats = {}
+            try:
+                response = await self.retry.run(attempt, stats)
+                attrs["status"] = response.status_code
+                return response
+            finally:
+                attrs["attempts"] = stats.get("attempts")
+
+    async def post(self, url, body, idempotency_key=None):
+        """
+        Posts a JSON body to url and returns the response, or None if it could not be delivered,
+        in which case it has been spooled
+
+        """
+        if idempotency_key is None:
+            idempotency_key = uuid.uuid4().hex
+        try:
+            return await self._deliver(url, body, idempotency_key)
+        except Exception as e:
+            if not self.retry.is_retryable(e):
+                raise
+            path = self.spool(url, body, idempotency_key)
+            logger.error(f"Could not post to {url} ({type(e).__name__}), saved it to {path}")
+            return None
+
+    def spool(self, url, body, idempotency_key):
+        """
+        Saves an undelivered post to the spool directory. Returns its path
+
+        """
+        os.makedirs(self.spool_dir, exist_ok=True)
+        path = os.path.join(self.spool_dir, f"{time.time_ns()}-{idempotency_key}.json")
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({ "url": url, "body": body, "idempotency_key": idempotency_key }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return path
+
+    def spooled(self):
+        """
+        Returns the paths of the spooled posts, oldest first
+
+        """
+        if not os.path.isdir(self.spool_dir):
+            return []
+        return sorted(os.path.join(self.spool_dir, name) for name in os.listdir(self.spool_dir) if name.endswith(".json"))
+
+    async def flush(self):
+        """
+        Sends every spooled post again, with its original idempotency key. Delivered posts are removed
+        from the spool, and posts the server rejects are moved to its rejected folder.
+        Returns (delivered, rejected, still spooled)
+
+        """
+        delivered = rejected = remaining = 0
+        for path in self.spooled():
+            with open(path, 'r') as f:
+                entry = json.load(f)
+            try:
+                response = await self._deliver(entry["url"], entry["body"], entry["idempotency_key"])
+            except Exception as e:
+                if not self.retry.is_retryable(e):
+                    raise
+                logger.warning(f"Could not post {path} ({type(e).__name__}), leaving it spooled")
+                remaining += 1
+                continue
+            if response.status_code == 200:
+                os.remove(path)
+                delivered += 1
+            else:
+                logger.error(f"{entry['url']} rejected {path}: {response.text}")
+                os.makedirs(os.path.join(self.spool_dir, REJECTED), exist_ok=True)
+                os.replace(path, os.path.join(self.spool_dir, REJECTED, os.path.basename(path)))
+                rejected += 1
+        return delivered, rejected, remaining
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='FeedBot result poster'
+    )
+
+    parser.add_argument('command', choices=["flush", "list"])
+    parser.add_argument('--spool-dir', default = DEFAULT_SPOOL_DIR)
+    parser.add_argument('--gzip', action = "store_true", default = False)
+    parser.add_argument('-d', '--debug', action='store_true')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.debug else logging.WARNING)
+
+    poster = ResultPoster(args.spool_dir, compress=args.gzip)
+    if args.command == "list":
+        for path in poster.spooled():
+            print(path)
+    else:
+        async def flush():
+            try:
+                return await poster.flush()
+            finally:
+                await poster.close()
+        delivered, rejected, remaining = asyncio.run(flush())
+        print(f"{delivered} delivered, {rejected} rejected, {remaining} still spooled")
+        if remaining:
+            raise SystemExit(1)
@@ -1,112 +1,619 @@
 import asyncio
+import functools
+import heapq
 import re
+import time
+import weakref
+from contextlib import asynccontextmanager
 import tiktoken
 import logging
 logger = logging.getLogger(__name__)
 from validate import validateSubmissionProb, json_has, json_has_or
+from submission import normalize_response
+from metrics import span
 
 # Makes an API request with the given string prompt
-# (OpenAI, str, str, str, str) -> str
-async def make_api_request(model, client, prompt, prob_path, sysmsg=None):
-    messages=[]
+# If a ResponseCache is given, an identical earlier request is answered from it without calling the API
+# If a RateLimiter is given, the request waits for its turn under the limiter's RPM/TPM/concurrency limits
+# If a RetryPolicy is given, the request is timed out, retried and/or hedged under it
+# Attempt counts, latency and time spent waiting on the limiter are recorded in the stats dict, if given,
+# and in an api_request span (see metrics.py)
+# input_tokens is the prompt's token count, if the caller already has it
+# If a stream factory is given, the completion is streamed: each attempt feeds the text as it arrives
+# into a fresh sink made by stream() (e.g. a StreamingPostprocessor), the time to the first token is
+# recorded in stats, and the winning attempt's sink is returned instead of the text
+# If samples is given, that many completions are requested (without streaming) and a list of their texts
+# is returned: all from one request where the model takes several completions per request, else
+# from concurrent requests (see sample_concurrently)
+# (OpenAI, str, str, str, str, ResponseCache, RateLimiter, RetryPolicy, dict, int, () -> Sink, int) -> str | Sink | list[str]
+async def make_api_request(model, client, prompt, prob_path, sysmsg=None, cache=None, limiter=None, retry=None, stats=None, input_tokens=None, stream=None, samples=None):
+    if stats is None:
+        stats = {}
+    if samples is not None and not takes_n(model):
+        return await sample_concurrently(model, client, prompt, prob_path, sysmsg, cache, limiter, retry, stats, input_tokens, samples)
+    with span("api_request", model=model) as attrs:
+        try:
+            return await _make_api_request(model, client, prompt, prob_path, sysmsg, cache, limiter, retry, stats, input_tokens, stream, samples)
+        finally:
+            attrs.update({ k: v for k, v in stats.items() if k != "segment_tokens" })
 
-    is_o1 = model == "o1-mini"
+async def _make_api_request(model, client, prompt, prob_path, sysmsg, cache, limiter, retry, stats, input_tokens, stream, samples):
+    logger.info(f"\n{prob_path}\n=================================================================================================\nUser: \n{prompt}\n")
 
-    if sysmsg is not None and not is_o1:
-        # NOTE(dbp 2024/9/24): no system messages in o1-mini for now
-        messages.append({ "role": "system", "content": sysmsg })
-    messages.append({ "role": "user", "content": prompt })
+    request = build_request(model, prompt, sysmsg, samples)
+    messages = request["messages"]
 
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key(request)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            stats["cache_hit"] = True
+            logger.info(f"\n--------------------------------------------\n CACHE HIT: {cache_key}\n--------------------------------------------\n")
+            if stream is not None:
+                sink = stream()
+                sink.feed(cached)
+                return sink
+            return cached
 
+    if input_tokens is None:
+        input_tokens = sum(count_tokens(model, m["content"]) for m in messages)
+    else:
+        input_tokens += sum(count_tokens(model, m["content"]) for m in messages if m["role"] == "system")
+    logger.info(f"\n--------------------------------------------\n INPUT TOKENS: {input_tokens}\n--------------------------------------------\n")
 
-    logger.info(f"\n{prob_path}\n=================================================================================================\nUser: \n{prompt}\n")
+    # Returns (text, usage, sink) for one attempt at the request
+    async def complete():
+        if stream is None:
+            completion = await client.chat.completions.create(**request)
+            if samples is not None:
+                choices = sorted(completion.choices, key=lambda choice: choice.index)
+                return [choice.message.content for choice in choices], getattr(completion, "usage", None), None
+            return completion.choices[0].message.content, getattr(completion, "usage", None), None
+        sink = stream()
+        parts = []
+        usage = None
+        start = time.monotonic()
+        chunks = await client.chat.completions.create(**request, stream=True, stream_options={ "include_usage": True })
+        async for chunk in chunks:
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if not parts:
+                    stats.setdefault("ttft", time.monotonic() - start)
+                parts.append(chunk.choices[0].delta.content)
+                sink.feed(parts[-1])
+        return "".join(parts), usage, sink
 
-    tokenizer = tiktoken.encoding_for_model(model)
+    # Waits for a rate limiter slot and budget, recording the time spent queued
+    @asynccontextmanager
+    async def admit():
+        queued = time.monotonic()
+        async with limiter.acquire(input_tokens, samples or 1) as reservation:
+            stats["queue_wait"] = stats.get("queue_wait", 0) + time.monotonic() - queued
+            yield reservation
 
-    # This is a little inaccurate, since it counts the role stuff, but should be okay
-    ts = tokenizer.encode(str(messages))
-    logger.info(f"\n--------------------------------------------\n INPUT TOKENS: {len(ts)}\n--------------------------------------------\n")
+    # One attempt, once admitted: only this part is timed out (or hedged) by the RetryPolicy
+    async def attempt(reservation=None):
+        text, usage, sink = await complete()
+        if reservation is not None:
+            reservation.settle(usage.total_tokens if usage is not None else None)
+        return text, usage, sink
 
-    if is_o1:
-        chat_completion = await client.chat.completions.create(
-            messages=messages,
-            model=model,
-            # NOTE(dbp 2024/9/24): no temp in o1-mini for now
-            #temperature=0.22
-        )
+    if retry is None:
+        start = time.monotonic()
+        stats["attempts"] = 1
+        if limiter is None:
+            text, usage, sink = await attempt()
+        else:
+            async with admit() as reservation:
+                text, usage, sink = await attempt(reservation)
+        stats["latency"] = time.monotonic() - start
     else:
-        chat_completion = await client.chat.completions.create(
-            messages=messages,
-            model=model,
-            temperature=0.22
-        )
+        text, usage, sink = await retry.run(attempt, stats, admit if limiter is not None else None)
+
+    #Reported usage, including how much of the prompt the provider served from its prefix cache
+    record_usage(stats, usage)
 
     #Output token usage
-    ts = tokenizer.encode(str(chat_completion.choices[0].message.content))
-    logger.info(f"\n--------------------------------------------\n OUTPUT TOKENS: {len(ts)}\n--------------------------------------------\n")
+    if usage is not None:
+        output_tokens = usage.completion_tokens
+    else:
+        output_tokens = sum(len(get_tokenizer(model).encode(t)) for t in (text if samples is not None else [text]))
+    logger.info(f"\n--------------------------------------------\n OUTPUT TOKENS: {output_tokens}\n--------------------------------------------\n")
 
     logger.info("=================================================================================================\n\n\n")
-    
-    return chat_completion.choices[0].message.content
+
+    if cache is not None:
+        cache.put(cache_key, text)
+    return text if stream is None else sink
+
+# Makes `samples` identical requests concurrently, for a model that only returns one completion
+# per request. Returns their texts. Their stats are combined into the given dict: attempts and
+# tokens are summed, while latency and time spent waiting on the limiter are the slowest request's.
+# The list of texts is cached as a whole, under the request for that many completions, since
+# caching each request on its own would answer every sample with the same text
+async def sample_concurrently(model, client, prompt, prob_path, sysmsg, cache, limiter, retry, stats, input_tokens, samples):
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key(build_request(model, prompt, sysmsg, samples))
+        cached = cache.get(cache_key)
+        if cached is not None:
+            stats["cache_hit"] = True
+            return cached
+
+    sample_stats = [{} for _ in range(samples)]
+    texts = await asyncio.gather(*[make_api_request(model, client, prompt, prob_path, sysmsg, None, limiter, retry, s, input_tokens)
+                                   for s in sample_stats])
+    for s in sample_stats:
+        add_stats(stats, s, concurrent=True)
+
+    if cache is not None:
+        cache.put(cache_key, texts)
+    return texts
+
+# Stats that are times, rather than counts
+TIMED_STATS = ["latency", "queue_wait", "ttft"]
+
+# Adds the stats of another request to stats: attempts and token counts are summed, and so are times,
+# unless the requests ran concurrently, in which case the slowest request's time is kept
+# (dict, dict, bool) -> None
+def add_stats(stats, more, concurrent=False):
+    for k, v in more.items():
+        if isinstance(v, bool) or not isinstance(v, (int, float)):
+            stats[k] = v
+        elif concurrent and k in TIMED_STATS:
+            stats[k] = max(stats.get(k, 0), v)
+        else:
+            stats[k] = stats.get(k, 0) + v
+
+# Whether a model can return several completions for one request (the n parameter)
+# str -> bool
+def takes_n(model):
+    # NOTE: o1-mini only returns one completion per request
+    return model != "o1-mini"
+
+# Builds the body of a chat completion request for the given string prompt,
+# asking for `samples` completions if given
+# (str, str, str, int) -> dict
+def build_request(model, prompt, sysmsg=None, samples=None):
+    messages=[]
+
+    is_o1 = model == "o1-mini"
+
+    if sysmsg is not None and not is_o1:
+        # NOTE(dbp 2024/9/24): no system messages in o1-mini for now
+        messages.append({ "role": "system", "content": sysmsg })
+    messages.append({ "role": "user", "content": prompt })
+
+    # NOTE: o1-mini takes no temperature, so it is left out of the request (and the cache key)
+    request = { "messages": messages, "model": model }
+    if not is_o1:
+        request["temperature"] = 0.22
+    if samples is not None:
+        request["n"] = samples
+    return request
+
+# Returns the tokenizer for a model, loading it only once per process
+# str -> Encoding
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(model):
+    return tiktoken.encoding_for_model(model)
+
+# Returns the number of tokens in a text. Memoized, since most prompt segments repeat across requests
+# (str, str) -> int
+@functools.lru_cache(maxsize=4096)
+def count_tokens(model, text):
+    return len(get_tokenizer(model).encode(text, disallowed_special=()))
+
+# Records the prompt, cached prompt and completion token counts from an API usage object in stats
+# (dict, CompletionUsage) -> None
+def record_usage(stats, usage):
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    stats["prompt_tokens"] = usage.prompt_tokens
+    stats["cached_tokens"] = (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+    stats["completion_tokens"] = usage.completion_tokens
+    logger.info(f"\n--------------------------------------------\n CACHED PROMPT TOKENS: {stats['cached_tokens']} of {stats['prompt_tokens']}\n--------------------------------------------\n")
 
 def render_path(p):
     return ", ".join(p)
 
-def find_with_path(l, p):
-    for r in l:
-        if r["path"] == render_path(p.path):
-            return r
-    return None
-
 # Gets a response from OpenAI, given the OpenAI client, the assignment, student submission, 
 # and config. probs is an int index of a problem to check. 
 # If omitted, all problems are tested.
-# (OpenAI, dict, SubmissionTemplate, dict, probs=int) -> list[dict]
-async def get_comment(client, assignment, submission, config, prob=None):
+# Comments are returned in the assignment's problem order
+# reuse maps problem indices to comments that are used as they are, without a request
+# (OpenAI, dict, SubmissionTemplate, dict, probs=int, cache=ResponseCache, limiter=RateLimiter, retry=RetryPolicy, reuse=dict) -> list[dict]
+async def get_comment(client, assignment, submission, config, prob=None, cache=None, limiter=None, retry=None, reuse=None):
     config_msg = config["system"]
     logger.info(f"\nCommon system message:\n--------------------------------------------\n{config_msg}\n--------------------------------------------\n")
+    res = []
+    async for i, comment in stream_comments(client, assignment, submission, config, prob, cache, limiter, retry, reuse):
+        res.append((i, comment))
+    unstarted = sum(1 for _, comment in res if comment["stats"].get("unstarted"))
+    if unstarted:
+        logger.info(f"\n--------------------------------------------\n UNSTARTED: {unstarted} of {len(res)} problems answered without a request\n--------------------------------------------\n")
+    return [comment for _, comment in sorted(res, key=lambda r: r[0])]
+
+# Gets comments for the assignment's problems (or only problem prob) concurrently, yielding
+# (problem index, comment) pairs as they finish, but in dependency order: each comment is yielded
+# as soon as it and the comments on the problems it (transitively) depends on are done, so a problem's
+# comment never lands before those, and is never held back by a slower problem it does not depend on.
+# Requests are sent in dependency order too, or, if the config sets "dependencies_first",
+# most-depended-on problems first, so the feedback that matters most for later problems lands earliest.
+# Problems with a comment in reuse (by index) are not sent at all.
+# (OpenAI, dict, SubmissionTemplate, dict, probs=int, cache=ResponseCache, limiter=RateLimiter, retry=RetryPolicy, reuse=dict) -> AsyncIterator[(int, dict)]
+async def stream_comments(client, assignment, submission, config, prob=None, cache=None, limiter=None, retry=None, reuse=None):
     if prob is None:
         probs = assignment.problems
+        indices = list(range(len(probs)))
     else:
         probs = [assignment.problems[prob]]
-    res = await asyncio.gather(*[get_comment_on_prob(client, assignment, submission, p, config) for p in probs])
-    reordered = [find_with_path(res, p) for p in probs]
-    return [x for x in reordered if x is not None]
+        indices = [prob]
+
+    order = dependency_order(probs)
+    if json_has_or(config, "dependencies_first", bool, False):
+        dispatch = most_depended_on_first(probs)
+    else:
+        dispatch = order
+
+    if reuse is None:
+        reuse = {}
+
+    async def reused(comment):
+        return comment
+
+    tasks = {}
+    for i in dispatch:
+        if indices[i] in reuse:
+            tasks[i] = asyncio.ensure_future(reused(reuse[indices[i]]))
+        else:
+            tasks[i] = asyncio.ensure_future(get_comment_on_prob(client, assignment, submission, probs[i], config, cache, limiter, retry))
+    # the dependencies each comment waits for; in a cycle, only those before it in the order
+    position = { i: k for k, i in enumerate(order) }
+    blockers = [{ d for d in deps if position[d] < position[i] } for i, deps in enumerate(dependency_graph(probs))]
+    problem_of = { task: i for i, task in tasks.items() }
+    finished = set()
+    yielded = set()
+    try:
+        pending = set(tasks.values())
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            finished.update(problem_of[task] for task in done)
+            while True:
+                ready = sorted((i for i in finished - yielded if blockers[i] <= yielded), key=position.get)
+                if not ready:
+                    break
+                for i in ready:
+                    yielded.add(i)
+                    yield indices[i], tasks[i].result()
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+# Returns, for each problem, the indices of the problems in the list it depends on
+# (dependencies outside the list, e.g. when grading a single problem, are left out)
+# list[ProblemStatement] -> list[list[int]]
+def dependency_graph(problems):
+    index = { tuple(p.path): i for i, p in enumerate(problems) }
+    graph = []
+    for i, p in enumerate(problems):
+        deps = { index[tuple(d)] for d in p.dependencies if tuple(d) in index }
+        deps.discard(i)
+        graph.append(sorted(deps))
+    return graph
+
+# Returns the indices of the problems in dependency order: every problem comes after the
+# problems it depends on, and problems are otherwise kept in the order given.
+# Problems in a dependency cycle are left in the order given, at the end.
+# list[ProblemStatement] -> list[int]
+def dependency_order(problems):
+    graph = dependency_graph(problems)
+    dependents = [[] for _ in problems]
+    waiting = [len(deps) for deps in graph]
+    for i, deps in enumerate(graph):
+        for d in deps:
+            dependents[d].append(i)
+
+    ready = [i for i, w in enumerate(waiting) if w == 0]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        i = heapq.heappop(ready)
+        order.append(i)
+        for j in dependents[i]:
+            waiting[j] -= 1
+            if waiting[j] == 0:
+                heapq.heappush(ready, j)
+
+    if len(order) < len(problems):
+        logger.warning("Problem dependencies form a cycle; ordering those problems as given")
+        done = set(order)
+        order += [i for i in range(len(problems)) if i not in done]
+    return order
+
+# Returns the indices of the problems ordered by how many problems (directly or indirectly)
+# depend on them, most first, breaking ties by dependency order
+# list[ProblemStatement] -> list[int]
+def most_depended_on_first(problems):
+    dependents = [[] for _ in problems]
+    for i, deps in enumerate(dependency_graph(problems)):
+        for d in deps:
+            dependents[d].append(i)
+
+    reach = []
+    for i in range(len(problems)):
+        seen = set()
+        stack = list(dependents[i])
+        while stack:
+            j = stack.pop()
+            if j not in seen and j != i:
+                seen.add(j)
+                stack.extend(dependents[j])
+        reach.append(len(seen))
+
+    position = { i: k for k, i in enumerate(dependency_order(problems)) }
+    return sorted(range(len(problems)), key=lambda i: (-reach[i], position[i]))
 
 # Gets a response from OpenAI for a particular problem number, 
 # given the OpenAI client, asignment, student submission, the problem, and config 
-# (OpenAI, Assignment, SubmissionTemplate, ProblemStatement, dict) -> dict
-async def get_comment_on_prob(client, assignment, submission, problem, config):
-    try:
-        validateSubmissionProb(problem.path, submission)
-        code = submission.at(problem.path, True).contents()
-        dependencies_code = submission.extract_responses(problem.dependencies)
-
-        res = {
-            "path" : render_path(problem.path),
-            "prompt" : "none",
-            "text" : "none",
-            "code" : code
-        }
-
-        prompt = get_prompt_using_config(problem, code, assignment, config, dependencies_code)
-        res["prompt"] = prompt
-        res["text"] = await make_api_request(config["model"], client, prompt, "=>".join(problem.path), config["system"])
-        if json_has(config, "delimiter", str):
-            res["text"] = cut_at_delimiter(res["text"], config["delimiter"])
-        res["text"] = redact_codeblocks(res["text"])
-        res["text"] = res["text"].strip()
-    except:
-        logging.exception('')
-        res = {
-            "path": render_path(problem.path),
-            "prompt": "ERROR",
-            "text": "ERROR",
-            "code": "ERROR"
-        }
+# The result's "stats" record the attempts and latency of the request
+# (OpenAI, Assignment, SubmissionTemplate, ProblemStatement, dict, ResponseCache, RateLimiter, RetryPolicy) -> dict
+async def get_comment_on_prob(client, assignment, submission, problem, config, cache=None, limiter=None, retry=None):
+    stats = {}
+    with span("problem", problem=render_path(problem.path), tags=",".join(problem.tags)) as attrs:
+        try:
+            validateSubmissionProb(problem.path, submission)
+            code = submission.at(problem.path, True).contents()
+            dependencies_code = submission.extract_responses(problem.dependencies)
+
+            res = {
+                "path" : render_path(problem.path),
+                "prompt" : "none",
+                "text" : "none",
+                "code" : code
+            }
 
+            canned = unstarted_comment(problem, config)
+            if canned is not None and problem.is_unstarted(code):
+                # nothing for the model to comment on, so no request is made
+                stats["unstarted"] = True
+                attrs["unstarted"] = True
+                res["text"] = canned
+                res["stats"] = stats
+                return res
+
+            with span("prompt_build") as build_attrs:
+                prompt, segment_tokens = build_prompt(problem, code, assignment, config, dependencies_code)
+                build_attrs["input_tokens"] = sum(segment_tokens.values())
+            stats["segment_tokens"] = segment_tokens
+            res["prompt"] = prompt
+            samples = json_has_or(config, "samples", int, 1)
+            if json_has(config, "cascade", list) and samples > 1:
+                res["samples"], res["prompt"] = await sample_through_cascade(client, assignment, problem, code, dependencies_code, config, limiter, retry, stats, samples)
+                res["text"] = res["samples"][0]
+            elif samples > 1:
+                texts = await make_api_request(config["model"], client, prompt, "=>".join(problem.path), config["system"], cache, limiter, retry, stats,
+                                               sum(segment_tokens.values()), samples=samples)
+                res["samples"] = [postprocess(text, config) for text in texts]
+                res["text"] = res["samples"][0]
+            elif json_has(config, "cascade", list):
+                res["text"], res["prompt"] = await get_comment_through_cascade(client, assignment, problem, code, dependencies_code, config, cache, limiter, retry, stats)
+            elif json_has_or(config, "stream", bool, False):
+                processor = await make_api_request(config["model"], client, prompt, "=>".join(problem.path), config["system"], cache, limiter, retry, stats,
+                                                   sum(segment_tokens.values()), lambda: StreamingPostprocessor(config))
+                res["text"] = processor.finish()
+            else:
+                text = await make_api_request(config["model"], client, prompt, "=>".join(problem.path), config["system"], cache, limiter, retry, stats,
+                                              sum(segment_tokens.values()))
+                res["text"] = postprocess(text, config)
+        except:
+            logging.exception('')
+            attrs["failed"] = True
+            res = {
+                "path": render_path(problem.path),
+                "prompt": "ERROR",
+                "text": "ERROR",
+                "code": "ERROR"
+            }
+
+    res["stats"] = stats
     return res
 
+# Gets a comment through the config's "cascade" of models, cheapest first: each tier's response is
+# accepted unless it fails one of the tier's checks (see check_response), in which case the problem
+# escalates to the next tier. The last tier's response is always accepted. A tier with "tags" only
+# applies to problems with one of those tags. Each tier is traced as a tier span, and the tier that
+# answered, and the model, latency and escalation reason of every tier tried, are recorded in stats.
+# Each tier's prompt is built (and counted) for its own model, e.g. with the system prompt inlined for o1-mini
+# Returns the comment and the prompt of the tier that gave it
+# (OpenAI, Assignment, ProblemStatement, str, str, dict, ResponseCache, RateLimiter, RetryPolicy, dict) -> (str, str)
+async def get_comment_through_cascade(client, assignment, problem, code, dep_code, config, cache, limiter, retry, stats):
+    tiers = [tier for tier in config["cascade"] if not json_has(tier, "tags", list) or set(tier["tags"]) & set(problem.tags)]
+    if not tiers:
+        tiers = [{ "model": config["model"] }]
+
+    stats["tiers"] = []
+    for i, tier in enumerate(tiers):
+        last = i == len(tiers) - 1
+        asks_confidence = not last and json_has(tier, "min_confidence", (int, float))
+
+        with span("tier", model=tier["model"], tier=i) as attrs:
+            tier_stats = {}
+            start = time.monotonic()
+            prompt, segment_tokens = build_prompt(problem, code, assignment, tier_config(config, tier), dep_code)
+            input_tokens = sum(segment_tokens.values())
+            if asks_confidence:
+                confidence_prompt = json_has_or(tier, "confidence_prompt", str, CONFIDENCE_PROMPT)
+                prompt += confidence_prompt
+                input_tokens += count_tokens(tier["model"], confidence_prompt)
+            text = await make_api_request(tier["model"], client, prompt, "=>".join(problem.path), config["system"], cache, limiter, retry, tier_stats, input_tokens)
+            confidence = None
+            if asks_confidence:
+                text, confidence = split_confidence(text)
+            reason = None if last else check_response(text, confidence, tier, config)
+            attrs["escalated"] = reason is not None
+            attrs["reason"] = reason
+
+        add_stats(stats, tier_stats)
+        stats["tiers"].append({ "model": tier["model"], "latency": time.monotonic() - start, "reason": reason })
+        if reason is None:
+            stats["tier"] = i
+            return postprocess(text, config), prompt
+        logger.info(f"\n--------------------------------------------\n ESCALATING from {tier['model']}: {reason}\n--------------------------------------------\n")
+
+# Gets samples comments through the config's cascade, each going through it on its own (and concurrently),
+# since each may escalate differently. The responses are not cached, so the samples stay independent.
+# stats record the tiers tried for the first sample (whose comment is the text), and the model
+# that gave each sample under "sample_models"
+# Returns the comments and the prompt that gave the first one
+# (OpenAI, Assignment, ProblemStatement, str, str, dict, RateLimiter, RetryPolicy, dict, int) -> (list[str], str)
+async def sample_through_cascade(client, assignment, problem, code, dep_code, config, limiter, retry, stats, samples):
+    sample_stats = [{} for _ in range(samples)]
+    answers = await asyncio.gather(*[get_comment_through_cascade(client, assignment, problem, code, dep_code, config, None, limiter, retry, s)
+                                     for s in sample_stats])
+    for s in sample_stats:
+        add_stats(stats, s, concurrent=True)
+    stats["tier"] = sample_stats[0]["tier"]
+    stats["tiers"] = sample_stats[0]["tiers"]
+    stats["sample_models"] = [s["tiers"][-1]["model"] for s in sample_stats]
+    return [text for text, _ in answers], answers[0][1]
+
+# The config as a cascade tier sees it: the same prompts, for the tier's model. Made once per tier,
+# so the tier's prompt plan is only compiled once (see get_prompt_plan)
+# (dict, dict) -> dict
+def tier_config(config, tier):
+    if tier["model"] == config["model"]:
+        return config
+    entry = _tier_configs.get(id(tier))
+    if entry is None or entry[0] is not tier:
+        entry = (tier, dict(config, model=tier["model"]))
+        _tier_configs[id(tier)] = entry
+    return entry[1]
+
+_tier_configs = {}
+
+# Appended to the prompt of a cascade tier that checks the model's confidence, unless the tier has its own "confidence_prompt"
+CONFIDENCE_PROMPT = "\n\nAfter your response, on a line of its own, write CONFIDENCE: followed by a number from 0 to 1 saying how sure you are that your feedback is correct and complete."
+CONFIDENCE_PATTERN = re.compile(r'^[ \t*]*CONFIDENCE:[ \t*]*([0-9]*\.?[0-9]+)[ \t*]*$', re.IGNORECASE | re.MULTILINE)
+
+# Takes the self-reported confidence line (the last one, if there are several) out of a response
+# Returns the rest of the response and the confidence, or None if there is no such line
+# str -> (str, float)
+def split_confidence(text):
+    matches = list(CONFIDENCE_PATTERN.finditer(text))
+    if not matches:
+        return text, None
+    return CONFIDENCE_PATTERN.sub("", text), float(matches[-1].group(1))
+
+# Checks a cascade tier's response against the tier's acceptance checks. Returns why the response
+# is not acceptable, or None if it is. The checks, all optional, are
+#   "require_delimiter": the config's delimiter must be in the response
+#   "allow_code": if false, the comment must not contain code blocks (which would be redacted)
+#   "min_length", "max_length": bounds on the length of the comment, in characters
+#   "min_confidence": the model's self-reported confidence must be at least this
+# (str, float, dict, dict) -> str
+def check_response(text, confidence, tier, config):
+    comment = text
+    if json_has(config, "delimiter", str):
+        if config["delimiter"] not in text:
+            if json_has_or(tier, "require_delimiter", bool, False):
+                return "no delimiter"
+        else:
+            comment = cut_at_delimiter(text, config["delimiter"])
+    if not json_has_or(tier, "allow_code", bool, True) and CODEBLOCK_PATTERN.search(comment):
+        return "code block"
+    length = len(comment.strip())
+    if json_has(tier, "min_length", int) and length < tier["min_length"]:
+        return "too short"
+    if json_has(tier, "max_length", int) and length > tier["max_length"]:
+        return "too long"
+    if json_has(tier, "min_confidence", (int, float)):
+        if confidence is None:
+            return "no confidence"
+        if confidence < tier["min_confidence"]:
+            return "low confidence"
+    return None
+
+# Returns the canned comment for a problem the student has not started (see ProblemStatement.is_unstarted):
+# the config's "unstarted#TAG" for the first of the problem's tags that has one, or else its "unstarted".
+# Returns None if the config has neither, in which case unstarted problems are sent to the model as usual
+# (ProblemStatement, dict) -> str
+def unstarted_comment(problem, config):
+    for tag in problem.tags:
+        if json_has(config, f"unstarted#{tag}", str):
+            return config[f"unstarted#{tag}"]
+    return json_has_or(config, "unstarted", str, None)
+
+# Builds the prompt for a problem, truncated to the config's input token budget if it has one
+# Returns the prompt and the token count of each of its segments
+# (ProblemStatement, str, Assignment, dict, str) -> (str, dict)
+def build_prompt(problem, code, assignment, config, dep_code):
+    segments = get_prompt_segments(problem, code, assignment, config, dep_code)
+    if json_has(config, "input_token_budget", int):
+        segments = fit_to_budget(segments, config)
+    segment_tokens = { name: count_tokens(config["model"], text) for name, text in segments if text != "" }
+    return "".join(text for _, text in segments), segment_tokens
+
+# Turns a model response into the comment shown to the student: the part after the
+# config's delimiter (if it has one), with code blocks redacted
+# (str, dict) -> str
+def postprocess(text, config):
+    if json_has(config, "delimiter", str):
+        text = cut_at_delimiter(text, config["delimiter"])
+    text = redact_codeblocks(text)
+    return text.strip()
+
+# Gets comments for a whole roster of submissions, sending one request per group of identical
+# (problem path, normalized code, normalized dependency code) and fanning the result out to every
+# submission in the group. Returns the comments for each submission (in order) and dedup stats.
+# (OpenAI, Assignment, list[SubmissionTemplate], dict, prob=int, cache=ResponseCache, limiter=RateLimiter, retry=RetryPolicy) -> (list[list[dict]], dict)
+async def get_comments_for_roster(client, assignment, submissions, config, prob=None, cache=None, limiter=None, retry=None):
+    if prob is None:
+        probs = assignment.problems
+    else:
+        probs = [assignment.problems[prob]]
+
+    groups = {}
+    members = []
+    for submission in submissions:
+        keys = []
+        for p in probs:
+            key = (
+                tuple(p.path),
+                submission.at(p.path, False).has_data(),
+                normalize_response(submission.at(p.path, True).contents()),
+                normalize_response(submission.extract_responses(p.dependencies))
+            )
+            groups.setdefault(key, (submission, p))
+            keys.append(key)
+        members.append(keys)
+
+    group_keys = list(groups)
+    results = await asyncio.gather(*[get_comment_on_prob(client, assignment, groups[k][0], groups[k][1], config, cache, limiter, retry) for k in group_keys])
+    by_key = dict(zip(group_keys, results))
+
+    comments = []
+    for submission, keys in zip(submissions, members):
+        sub_comments = []
+        for p, key in zip(probs, keys):
+            res = dict(by_key[key])
+            if res["code"] != "ERROR":
+                res["code"] = submission.at(p.path, True).contents()
+            sub_comments.append(res)
+        comments.append(sub_comments)
+
+    total = len(submissions) * len(probs)
+    stats = {
+        "responses": total,
+        "requests": len(group_keys),
+        "dedup_ratio": (1 - len(group_keys) / total) if total else 0.0
+    }
+    logger.info(f"\n--------------------------------------------\n DEDUP: {stats['requests']} requests for {total} responses ({stats['dedup_ratio']:.1%} saved)\n--------------------------------------------\n")
+    return comments, stats
+
 # Given a string and delimiter, returns the part of the string occuring after 
 # the delimiter, or "[internal error]" if the delimiter is not present
 # (str, str) -> str
@@ -119,63 +626,211 @@ def cut_at_delimiter(text, delimiter):
 # str -> str
 def redact_codeblocks(text):
     # Regular expression pattern to match markdown code blocks
-    codeblock_pattern = r'```(?:.*)\n([\s\S]*?)```'
-    redacted_text = re.sub(codeblock_pattern, "[CODE REDACTED]", text)
+    redacted_text = CODEBLOCK_PATTERN.sub(CODE_REDACTED, text)
     return redacted_text
 
+CODEBLOCK_PATTERN = re.compile(r'```(?:.*)\n([\s\S]*?)```')
+CODE_REDACTED = "[CODE REDACTED]"
+FENCE = "```"
+
+# postprocess for a streamed completion: the delimiter cut and code block redaction are applied
+# as chunks arrive, holding back only what a later chunk could still change (a partial delimiter
+# or fence, or an unclosed code block). finish() returns exactly what postprocess would on the
+# whole text.
+class StreamingPostprocessor:
+    def __init__(self, config):
+        self.delimiter = config["delimiter"] if json_has(config, "delimiter", str) else None
+        self.raw = ""
+        self.searched = 0                                   # where the next delimiter search starts
+        self.start = 0 if self.delimiter is None else None  # where the comment starts, once known
+        self.pos = 0                                        # raw[start:pos] is redacted into out
+        self.out = []
+
+    def feed(self, chunk):
+        """
+        Adds the next chunk of the completion
+
+        """
+        self.raw += chunk
+        if self.delimiter is not None:
+            # the comment is what follows the last delimiter, so a new one starts it over
+            while True:
+                i = self.raw.find(self.delimiter, self.searched)
+                if i == -1:
+                    break
+                self.searched = self.start = self.pos = i + len(self.delimiter)
+                self.out = []
+            self.searched = max(self.searched, len(self.raw) - len(self.delimiter) + 1)
+        if self.start is not None:
+            self._redact()
+
+    def _redact(self):
+        while True:
+            i = self.raw.find(FENCE, self.pos)
+            if i == -1:
+                # up to two trailing backticks could still become a fence
+                end = len(self.raw)
+                while end > self.pos and end > len(self.raw) - 2 and self.raw[end - 1] == "`":
+                    end -= 1
+                self.out.append(self.raw[self.pos:end])
+                self.pos = end
+                return
+            self.out.append(self.raw[self.pos:i])
+            self.pos = i
+            match = CODEBLOCK_PATTERN.match(self.raw, i)
+            if match is None:
+                # the fence's line or block is not finished yet
+                return
+            self.out.append(CODE_REDACTED)
+            self.pos = match.end()
+
+    def finish(self):
+        """
+        Returns the comment, once the whole completion has been fed
+
+        """
+        if self.start is None:
+            return postprocess(self.raw, { "delimiter": self.delimiter })
+        return ("".join(self.out) + redact_codeblocks(self.raw[self.pos:])).strip()
+
 # Generates a prompt from the problem, code, config, and dependencies
 # (ProblemStatement, str, dict, dict, str) -> str
 def get_prompt_using_config(problem, code, assignment, config, dep_code):
-    has_grading_note = (problem.grading_note != "")
-    has_dependencies = (dep_code != "")
-    has_context = (problem.context.strip() != "")
-    has_code = (code.strip() != "")
-    prompt = ""
-
-    # system prompt (now here because o1-mini doesn't have system prompts)
-    if config["model"] == "o1-mini":
-        prompt += config["system"] + "\n\n"
-
-    # general prompt
-    prompt += get_prompt_for("general", problem, config)
-
-    # context (i.e. if the instructor provided extra instructions or data definitions at the top of the code)
-    if has_context:
-        prompt += get_prompt_for("pre_context", problem, config) \
-        + f"```\n{problem.context.strip()}\n```" \
-        + get_prompt_for("post_context", problem, config)
-    
-    # the problem statement (for the specific part, i.e. Problem 1D, or Problem 7A)
-    prompt += get_prompt_for("pre_statement", problem, config) \
-        + f"```\n{problem.statement.strip()}\n```" \
-        + get_prompt_for("post_statement", problem, config)
-    
-    # an additional grading note, if provided in the spec
-    if has_grading_note:
-        prompt += get_prompt_for("pre_gradenote", problem, config) \
-        + f"```\n{problem.grading_note.strip()}\n```" \
-        + get_prompt_for("post_gradenote", problem, config)
-
-
-    # past code from the student, if it is relevant for this problem
-    if has_dependencies:
-        prompt += get_prompt_for("pre_dependencies", problem, config) \
-        + f"```\n{dep_code.strip()}\n```" \
-        + get_prompt_for("post_dependencies", problem, config)
-    
-    # finally, student code
-    code = code if has_code else ";; blank response"
-    prompt += get_prompt_for("pre_code", problem, config) \
-        + f"```\n{code.strip()}\n```" \
-        + get_prompt_for("post_code", problem, config)
-    
-    return prompt
+    return get_prompt_plan(problem, config).render(code, dep_code)
+
+# Generates the prompt as a list of named segments, which join to the full prompt.
+# The instructor/student material in code blocks has its own segment (named "context",
+# "statement", "gradenote", "dependencies" and "code"), so it can be counted and truncated separately.
+# (ProblemStatement, str, dict, dict, str) -> list[(str, str)]
+def get_prompt_segments(problem, code, assignment, config, dep_code):
+    return get_prompt_plan(problem, config).segments(code, dep_code)
+
+# The prompt for one (problem, config), compiled once: every segment that does not depend on the
+# student is resolved up front (tag-specific prompts included), leaving slots for the student's
+# dependency code and code, so building a student's prompt is a single join.
+# With "layout": "prefix_cache" in the config, the segments shared by the most requests
+# (system, untagged general prompt, assignment context) come first and the tag-specific
+# general prompt follows them, so the provider can cache the longest possible prefix.
+class PromptPlan:
+    def __init__(self, problem, config):
+        prefix_layout = json_has_or(config, "layout", str, "") == "prefix_cache"
+        segments = []
+
+        # a piece of material in a code block, between its pre_ and post_ prompts
+        def block(name, prompt_name, text):
+            pre, post = self._wrappers(prompt_name, problem, config)
+            segments.extend([("pre_" + prompt_name, pre), (name, text.strip()), ("post_" + prompt_name, post)])
+
+        # system prompt (now here because o1-mini doesn't have system prompts)
+        if config["model"] == "o1-mini":
+            segments.append(("system", config["system"] + "\n\n"))
+
+        # general prompt
+        if prefix_layout:
+            segments.append(("general", config["general"]))
+        else:
+            segments.append(("general", get_prompt_for("general", problem, config)))
+
+        # context (i.e. if the instructor provided extra instructions or data definitions at the top of the code)
+        if problem.context.strip() != "":
+            block("context", "context", problem.context)
+
+        # tag-specific general prompt, after everything shared across problems
+        if prefix_layout:
+            segments.append(("general_tags", get_tag_prompt_for("general", problem, config)))
+
+        # the problem statement (for the specific part, i.e. Problem 1D, or Problem 7A)
+        block("statement", "statement", problem.statement)
+
+        # an additional grading note, if provided in the spec
+        if problem.grading_note != "":
+            block("gradenote", "gradenote", problem.grading_note)
+
+        self.head = segments
+        # slots for past code from the student, if it is relevant for this problem, and finally student code
+        self.dependencies = self._wrappers("dependencies", problem, config)
+        self.code = self._wrappers("code", problem, config)
+
+    @staticmethod
+    def _wrappers(prompt_name, problem, config):
+        # the text opening and closing a code block
+        return (get_prompt_for("pre_" + prompt_name, problem, config) + "```\n",
+                "\n```" + get_prompt_for("post_" + prompt_name, problem, config))
+
+    def segments(self, code, dep_code):
+        """
+        Returns the named segments of the prompt for a student's code and dependency code
+
+        """
+        segments = list(self.head)
+        if dep_code != "":
+            segments += [("pre_dependencies", self.dependencies[0]), ("dependencies", dep_code.strip()), ("post_dependencies", self.dependencies[1])]
+        code = code if code.strip() != "" else ";; blank response"
+        segments += [("pre_code", self.code[0]), ("code", code.strip()), ("post_code", self.code[1])]
+        return segments
+
+    def render(self, code, dep_code):
+        """
+        Returns the prompt for a student's code and dependency code
+
+        """
+        return "".join(text for _, text in self.segments(code, dep_code))
+
+# Compiled prompt plans, by problem and then by config (configs are not changed once loaded)
+_plans = weakref.WeakKeyDictionary()
+
+# Returns the compiled prompt plan for a problem and config, compiling it only the first time
+# (ProblemStatement, dict) -> PromptPlan
+def get_prompt_plan(problem, config):
+    plans = _plans.setdefault(problem, {})
+    entry = plans.get(id(config))
+    if entry is None or entry[0] is not config:
+        entry = (config, PromptPlan(problem, config))
+        plans[id(config)] = entry
+    return entry[1]
+
+# Segments that may be truncated to fit the input token budget, lowest priority first
+DEFAULT_TRUNCATION_ORDER = ["dependencies", "context", "code"]
+
+# Shortens prompt segments so the prompt (and system message) fit in config["input_token_budget"] tokens.
+# Segments are cut from the end, in the order of config["truncation_order"] (default: previous code,
+# then assignment context, then student code), each only as far as needed.
+# (list[(str, str)], dict) -> list[(str, str)]
+def fit_to_budget(segments, config):
+    model = config["model"]
+    budget = config["input_token_budget"]
+    if model != "o1-mini":
+        budget -= count_tokens(model, config["system"])
+    excess = sum(count_tokens(model, text) for _, text in segments) - budget
+    if excess <= 0:
+        return segments
+
+    segments = list(segments)
+    tokenizer = get_tokenizer(model)
+    for name in json_has_or(config, "truncation_order", list, DEFAULT_TRUNCATION_ORDER):
+        for i, (segment_name, text) in enumerate(segments):
+            if segment_name != name or excess <= 0:
+                continue
+            tokens = tokenizer.encode(text, disallowed_special=())
+            marker = f"\n;; [{min(excess, len(tokens))} tokens truncated]"
+            keep = max(0, len(tokens) - excess - count_tokens(model, marker))
+            segments[i] = (segment_name, tokenizer.decode(tokens[:keep]) + marker)
+            excess -= len(tokens) - count_tokens(model, segments[i][1])
+            logger.info(f"\n--------------------------------------------\n TRUNCATED {segment_name} TO {keep} TOKENS\n--------------------------------------------\n")
+    if excess > 0:
+        logger.warning(f"Prompt is still {excess} tokens over the input token budget after truncation")
+    return segments
 
 # Gets the prompt info for a certain config attribute name
 # names followed by #TAG will also be included if the problem has that tag
 # (str, ProblemStatement, dict) -> str
 def get_prompt_for(name, problem, config):
-    text = config[name]
+    return config[name] + get_tag_prompt_for(name, problem, config)
+
+# Gets only the #TAG parts of the prompt info for a certain config attribute name
+# (str, ProblemStatement, dict) -> str
+def get_tag_prompt_for(name, problem, config):
+    text = ""
     for tag in problem.tags:
         if (name + "#" + tag) in config:
             text += config[name + "#" + tag]
@@ -0,0 +1,111 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+# A token bucket holding up to `per_minute` units, refilled continuously at per_minute / 60 units per second
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """
+        Returns how many seconds until `amount` units are available (0 if they are now)
+
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.level -= amount
+
+    def give(self, amount):
+        """
+        Returns (or, if negative, takes) units after the real cost of a request is known
+
+        """
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+# Shared scheduler for API requests: requests-per-minute and tokens-per-minute buckets,
+# plus a cap on how many requests are in flight at once. Any limit may be None (unlimited).
+# Not tied to an event loop, so one limiter can be shared by successive asyncio.run calls.
+class RateLimiter:
+    def __init__(self, rpm=None, tpm=None, max_in_flight=None, expected_output_tokens=1000):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_in_flight = max_in_flight
+        self.expected_output_tokens = expected_output_tokens
+        self._semaphore = None
+        self._loop = None
+
+    def _slot(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._semaphore
+
+    def estimate(self, input_tokens, completions=1):
+        """
+        Returns the number of tokens reserved up front for a request with the given input size
+        that asks for the given number of completions (the prompt is only counted once)
+
+        """
+        return input_tokens + completions * self.expected_output_tokens
+
+    async def _wait_for_budget(self, tokens):
+        while True:
+            wait = 0
+            if self.requests is not None:
+                wait = max(wait, self.requests.wait_time(1))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.wait_time(tokens))
+            if wait == 0:
+                break
+            await asyncio.sleep(wait)
+
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+
+    @asynccontextmanager
+    async def acquire(self, input_tokens, completions=1):
+        """
+        Waits for an in-flight slot and enough request/token budget for a request with the given input size
+        and number of completions. Yields a Reservation; call its settle() with the actual token usage once it is known.
+
+        """
+        reservation = Reservation(self, self.estimate(input_tokens, completions))
+        if self.max_in_flight is None:
+            await self._wait_for_budget(reservation.tokens)
+            yield reservation
+        else:
+            async with self._slot():
+                await self._wait_for_budget(reservation.tokens)
+                yield reservation
+
+
+# The token budget taken for one request, corrected once the API reports the real usage
+class Reservation:
+    def __init__(self, limiter, tokens):
+        self.limiter = limiter
+        self.tokens = tokens
+
+    def settle(self, actual_tokens):
+        if self.limiter.tokens is not None and actual_tokens is not None:
+            self.limiter.tokens.give(self.tokens - actual_tokens)
+        self.tokens = actual_tokens
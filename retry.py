@@ -0,0 +1,137 @@
+import asyncio
+import email.utils
+import random
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = (408, 409, 429)
+
+# How a single API call is retried: a per-attempt timeout, jittered exponential backoff
+# (or the server's Retry-After, when it sends one), and optional hedging, where a duplicate
+# request is fired if the first has not answered after `hedge_after` seconds.
+class RetryPolicy:
+    def __init__(self, timeout=120, max_attempts=3, base_delay=1, max_delay=60, hedge_after=None):
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_after = hedge_after
+
+    def is_retryable(self, error):
+        import httpx
+        import openai
+        if isinstance(error, (asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError, httpx.TransportError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return self.is_retryable_status(error.status_code)
+        if isinstance(error, httpx.HTTPStatusError):
+            return self.is_retryable_status(error.response.status_code)
+        return False
+
+    def is_retryable_status(self, status_code):
+        return status_code in RETRYABLE_STATUS or status_code >= 500
+
+    def backoff(self, attempt, error):
+        """
+        Returns how long to wait before the next attempt, after `attempt` attempts failed with `error`
+
+        """
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def run(self, call, stats=None, admit=None):
+        """
+        Runs `call` (a function returning a fresh awaitable) under this policy and returns its result.
+        If `admit` is given (a function returning an async context manager, e.g. a rate limiter slot),
+        each attempt first enters it and `call` is passed what it yields; the timeout and the hedge
+        clock only start once an attempt is admitted, so time spent queued does not count.
+        Records attempts, hedged requests and total latency in `stats`, if given.
+
+        """
+        if stats is None:
+            stats = {}
+        stats.setdefault("attempts", 0)
+        stats.setdefault("hedged", 0)
+        start = time.monotonic()
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    return await self._hedged(call, stats, admit)
+                except Exception as e:
+                    if attempt == self.max_attempts or not self.is_retryable(e):
+                        raise
+                    delay = self.backoff(attempt, e)
+                    logger.warning(f"Attempt {attempt} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+        finally:
+            stats["latency"] = time.monotonic() - start
+
+    async def _attempt(self, call, stats, admit, admitted):
+        if admit is None:
+            stats["attempts"] += 1
+            admitted.set()
+            return await asyncio.wait_for(call(), self.timeout)
+        async with admit() as admission:
+            stats["attempts"] += 1
+            admitted.set()
+            return await asyncio.wait_for(call(admission), self.timeout)
+
+    async def _hedged(self, call, stats, admit):
+        admitted = asyncio.Event()
+        first = asyncio.ensure_future(self._attempt(call, stats, admit, admitted))
+        if self.hedge_after is None:
+            return await first
+
+        pending = {first}
+        try:
+            # the hedge clock starts once the first attempt is admitted (or has already finished)
+            waiter = asyncio.ensure_future(admitted.wait())
+            await asyncio.wait({first, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_after)
+            if not done:
+                stats["hedged"] += 1
+                pending.add(asyncio.ensure_future(self._attempt(call, stats, admit, asyncio.Event())))
+
+            error = None
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+# Returns the delay the server asked for in a Retry-After(-ms) header, or None
+# (Exception) -> float | None
+def retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
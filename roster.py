@@ -0,0 +1,66 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+from openai import AsyncOpenAI
+
+from submission import SubmissionTemplate
+from assignment import AssignmentStatement
+from query import get_comments_for_roster
+from ratelimit import RateLimiter
+from retry import RetryPolicy
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# Gets feedback for every submission in a folder, deduplicating identical responses across the roster
+# Writes one results JSON per submission, plus the dedup stats, to the result folder
+def grade_roster(sub_folder_path, config_path, result_folder_path, assignment_path, spec_path, prob_num, limiter=None, retry=None):
+    subs = sorted(os.listdir(sub_folder_path))
+    subs = [f for f in subs if os.path.isfile(os.path.join(sub_folder_path, f))]
+
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+
+    assignment = AssignmentStatement.load(spec_path, assignment_path)
+    submissions = [SubmissionTemplate.load(os.path.join(sub_folder_path, sub)) for sub in subs]
+
+    key = os.environ["OPENAI_KEY"]
+    client = AsyncOpenAI(api_key=key) if retry is None else AsyncOpenAI(api_key=key, max_retries=0)
+    comments, stats = asyncio.run(get_comments_for_roster(client, assignment, submissions, config, prob_num, None, limiter, retry))
+
+    os.makedirs(result_folder_path, exist_ok=True)
+    for sub, answer in zip(subs, comments):
+        sub_name = sub.split('.')[0]
+        with open(os.path.join(result_folder_path, f"{sub_name}.json"), 'w') as result:
+            json.dump(answer, result)
+
+    with open(os.path.join(result_folder_path, "dedup.json"), 'w') as result:
+        json.dump(stats, result)
+
+    print(f"{stats['requests']} requests for {stats['responses']} responses ({stats['dedup_ratio']:.1%} deduplicated)")
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='FeedBot roster grader'
+    )
+
+    parser.add_argument('-s', '--submissions', required = True)
+    parser.add_argument('-c', '--config', default = "config.json")
+    parser.add_argument('-a', '--assignment', required = True)
+    parser.add_argument('-j', '--spec', required = True)
+    parser.add_argument('-r', '--results', required = True)
+    parser.add_argument('-p', '--problem', type=int)
+    parser.add_argument('-d', '--debug', action='store_true')
+    parser.add_argument('--rpm', type=int, default=500)
+    parser.add_argument('--tpm', type=int, default=200000)
+    parser.add_argument('--max-in-flight', type=int, default=32)
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.INFO)
+
+    grade_roster(args.submissions, args.config, args.results, args.assignment, args.spec, args.problem, RateLimiter(args.rpm, args.tpm, args.max_in_flight), RetryPolicy())
@@ -1,5 +1,66 @@
+#!/usr/bin/env python3
+
+import argparse
 import difflib
-from pathlib import Path
+import hashlib
+import json
+import os
+
+from submission import SubmissionTemplate
+from metrics import span
+
+FINGERPRINT_SUFFIX = ".starter.json"
+
+# The starter template's marker lines (those starting with ";;!"), in order, and a hash of them.
+# Computed once per template: written next to it by build.sh (see save), or on first load.
+class StarterFingerprint:
+    def __init__(self, markers):
+        self.markers = markers
+        self.digest = marker_digest(markers)
+
+    @staticmethod
+    def of(template: SubmissionTemplate):
+        """
+        Returns the fingerprint of an already parsed template
+
+        """
+        return StarterFingerprint(marker_lines(template))
+
+    @staticmethod
+    def load(template_path):
+        """
+        Returns the template's fingerprint, from the file written by save if it is there and
+        was made from a template with the same contents (by hash), or else by parsing the template
+
+        """
+        key = (os.path.abspath(template_path), os.path.getmtime(template_path))
+        fingerprint = _loaded.get(key)
+        if fingerprint is not None:
+            return fingerprint
+
+        try:
+            with open(template_path + FINGERPRINT_SUFFIX, 'r') as f:
+                saved = json.load(f)
+            if saved["template"] == template_hash(template_path) and saved["digest"] == marker_digest(saved["markers"]):
+                fingerprint = StarterFingerprint(saved["markers"])
+        except (OSError, ValueError, KeyError):
+            pass
+        if fingerprint is None:
+            fingerprint = StarterFingerprint.of(SubmissionTemplate.load(template_path))
+
+        _loaded[key] = fingerprint
+        return fingerprint
+
+    def save(self, template_path):
+        """
+        Writes this fingerprint next to the template, for load
+
+        """
+        with open(template_path + FINGERPRINT_SUFFIX, 'w') as f:
+            json.dump({ "template": template_hash(template_path), "digest": self.digest, "markers": self.markers }, f)
+
+# Fingerprints loaded in this process, by (template path, mtime)
+_loaded = {}
 
 def submission_uses_starter(output_lines, submission_path, template_path):
     """
@@ -9,15 +70,24 @@ def submission_uses_starter(output_lines, submission_path, template_path):
        are identical.
     2. Report the any extra/missing lines.
     """
+    return follows_starter(output_lines, SubmissionTemplate.load(submission_path), StarterFingerprint.load(template_path))
+
+def follows_starter(output_lines, submission: SubmissionTemplate, starter: StarterFingerprint):
+    """
+    Checks that an already parsed submission follows the starter template with the given
+    fingerprint, as submission_uses_starter does. The diff is only computed if it does not.
+    """
     MESSAGE = "Does the submission follow the starter file?"
-    
-    template_lines = _extract_template_lines(Path(template_path))
-    submission_lines = _extract_template_lines(Path(submission_path))
 
-    if template_lines == submission_lines:
+    with span("starter_check") as attrs:
+        template_lines = starter.markers
+        submission_lines = marker_lines(submission)
+        attrs["passed"] = template_lines == submission_lines
+
+    if attrs["passed"]:
         output_lines.append(f"✅ {MESSAGE}")
         return True
-    
+
     differ = difflib.Differ()
     diff = differ.compare(template_lines, submission_lines)
 
@@ -31,18 +101,34 @@ def submission_uses_starter(output_lines, submission_path, template_path):
     output_lines.append("```")
     return False
 
-def _extract_template_lines(file: Path):
-    """
-    Returns a list of the lines that begin with ";;!".
-    """
-    template_lines = []
-    with file.open("rt") as f:
-        for line in f:
-            # Just a hack to ensure we can test with the homework master.
-            if line.startswith(";;!hide"):
-                continue
-            if line.startswith(";;!show"):
-                continue
-            if line.startswith(";;!"):
-                template_lines.append(line.rstrip())
-    return template_lines
+def marker_lines(template: SubmissionTemplate):
+    """
+    Returns a list of the lines of a parsed file that begin with ";;!" (the parse already drops
+    the ;;!show and ;;!hide lines), read off the marker index built when it was loaded.
+    """
+    lines = template.index.lines
+    return [lines[i].rstrip() for i in template.index.markers]
+
+def template_hash(template_path):
+    """
+    Returns a hash of a template file's contents
+    """
+    with open(template_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def marker_digest(markers):
+    """
+    Returns a hash of a list of marker lines
+    """
+    return hashlib.sha256("\n".join(markers).encode("utf-8")).hexdigest()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='FeedBot starter template fingerprint'
+    )
+
+    parser.add_argument('template', help="writes the fingerprint of this template next to it")
+
+    args = parser.parse_args()
+
+    StarterFingerprint.of(SubmissionTemplate.load(args.template)).save(args.template)
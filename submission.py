@@ -1,82 +1,192 @@
+import hashlib
+from bisect import bisect_left
+from itertools import islice
 from typing import List
 
 MARKER = ";;!"
 RESPONSE_MARKER = ";;!!"
+HEADER_MARKER = MARKER + " "
+
+# Index over the marker lines of a file, built in a single pass when the file is loaded.
+# Shared (never copied) by every view of the file.
+class SectionIndex:
+    def __init__(self, lines: List[str]):
+        self.lines = lines
+        self.markers = []           # line numbers of every line starting with MARKER
+        self.responses = []         # line numbers of every line starting with RESPONSE_MARKER
+        self.headers = []           # line numbers of every line starting with HEADER_MARKER
+        self.matches = {}           # header marker -> line numbers that start with it, memoized by find()
+        self.resolved = {}          # (path, is_student_response) -> (start, end), memoized by at()
+        self.extracted = {}         # path -> student response text, memoized by response()
+
+        for i, line in enumerate(lines):
+            if not line.startswith(MARKER):
+                continue
+            self.markers.append(i)
+            if line.startswith(RESPONSE_MARKER):
+                self.responses.append(i)
+            if line.startswith(HEADER_MARKER):
+                self.headers.append(i)
+
+    def find(self, marker: str, start: int, end: int):
+        """
+        Returns the number of the first line in [start, end) starting with the marker, or None
+
+        """
+        if marker == MARKER:
+            positions = self.markers
+        elif marker == RESPONSE_MARKER:
+            positions = self.responses
+        elif marker.startswith(HEADER_MARKER):
+            positions = self.matches.get(marker)
+            if positions is None:
+                positions = [i for i in self.headers if self.lines[i].startswith(marker)]
+                self.matches[marker] = positions
+        else:
+            for i in range(start, end):
+                if self.lines[i].startswith(marker):
+                    return i
+            return None
+
+        k = bisect_left(positions, start)
+        if k < len(positions) and positions[k] < end:
+            return positions[k]
+        return None
+
+
 # Represents an rkt file/txt file that is either a student submitted file, assignment file, or a specific assignment problem
+# A SubmissionTemplate is a view (start/end line offsets) into a shared SectionIndex, so slicing never copies lines
 class SubmissionTemplate:
     @staticmethod
     def load(path):
         with open(path, "r") as file:
             lines = file.readlines()
-        
+
         #remove show/hide lines internally from this submission, to make testing reference solution easier
         filtered_lines = [line.rstrip("\n") for line in lines if not line.startswith((";;!show", ";;!hide"))]
         return SubmissionTemplate(filtered_lines)
 
     def __init__(self, lines: List[str]):
-        self.lines = lines
+        self.index = SectionIndex(lines)
+        self.start = 0
+        self.end = len(lines)
+
+    @staticmethod
+    def _view(index: SectionIndex, start: int, end: int):
+        view = SubmissionTemplate.__new__(SubmissionTemplate)
+        view.index = index
+        view.start = start
+        view.end = max(start, end)
+        return view
+
+    @property
+    def lines(self):
+        return self.index.lines[self.start:self.end]
 
     def after(self, marker: str):
         """
         Returns the contents of this submission after a line starting with the marker
-        
+
         """
-        for i, line in enumerate(self.lines):
-            if line.startswith(marker):
-                return SubmissionTemplate(self.lines[i + 1 :])
-        return SubmissionTemplate([])
+        i = self.index.find(marker, self.start, self.end)
+        if i is None:
+            return SubmissionTemplate._view(self.index, self.end, self.end)
+        return SubmissionTemplate._view(self.index, i + 1, self.end)
 
     def before(self, marker: str):
         """
         Returns the contents of this submission before the marker
 
         """
-        for i, line in enumerate(self.lines):
-            if line.startswith(marker):
-                return SubmissionTemplate(self.lines[:i])
-        return SubmissionTemplate(self.lines)
+        i = self.index.find(marker, self.start, self.end)
+        if i is None:
+            return self
+        return SubmissionTemplate._view(self.index, self.start, i)
 
     def contents(self):
         """
         Returns the contents as a single string
 
         """
-        return "\n".join(self.lines)
+        return "\n".join(islice(self.index.lines, self.start, self.end))
 
     def at(self, path, is_student_response):
         """
         Returns the contents indexed by the given path of marker strings..
 
-        Returns only problem __instructions__ (text before response marker) if is_student_response is false. 
+        Returns only problem __instructions__ (text before response marker) if is_student_response is false.
         Returns only student response (text after response marker) if is_student_response is true
-    
+
+        Lookups on a whole file are memoized, so repeated paths cost O(1) after the first.
+
         """
+        if self.start != 0 or self.end != len(self.index.lines):
+            return self._at(path, is_student_response)
+
+        key = (tuple(path), is_student_response)
+        bounds = self.index.resolved.get(key)
+        if bounds is None:
+            view = self._at(path, is_student_response)
+            self.index.resolved[key] = (view.start, view.end)
+            return view
+        return SubmissionTemplate._view(self.index, *bounds)
+
+    def _at(self, path, is_student_response):
         if path == []:
             if is_student_response:
                 return self.after(RESPONSE_MARKER).before(MARKER)
             else:
                 return self.before(MARKER)
         else:
-            return self.after(MARKER + " " + path[0]).at(path[1:], is_student_response)
+            return self.after(HEADER_MARKER + path[0])._at(path[1:], is_student_response)
 
 
+    def response(self, path):
+        """
+        Returns the student response at the given path as a single string.
+        Each response of a file is extracted once and shared by every problem that needs it.
+
+        """
+        if self.start != 0 or self.end != len(self.index.lines):
+            return self.at(path, True).contents()
+
+        key = tuple(path)
+        text = self.index.extracted.get(key)
+        if text is None:
+            text = self.at(path, True).contents()
+            self.index.extracted[key] = text
+        return text
+
     def extract_responses(self, problem_paths):
         """
         Given problem paths, extracts all student responses for these problem paths (to be used as dependencies)
-        
+
         """
         dependencies = ""
 
         for path in problem_paths:
             path_str = ",".join(path)
-            dependencies += f";;! Student response for {path_str}: \n" + self.at(path, True).contents() + "\n\n"
-        
-        
+            dependencies += f";;! Student response for {path_str}: \n" + self.response(path) + "\n\n"
+
+
         return dependencies
-    
+
     def has_data(self):
         """
         Returns if this submission template has any lines
-        
+
         """
-        return (self.lines != [])
+        return self.end > self.start
+
+# Normalizes a student response for deduplication: strips each line, collapses runs of
+# whitespace and drops blank lines. Comments are kept, since signatures and purpose
+# statements are comments and are part of what the feedback is about.
+# str -> str
+def normalize_response(code):
+    lines = [" ".join(line.split()) for line in code.splitlines()]
+    return "\n".join(line for line in lines if line != "")
+
+# Returns a hash of a normalized response, so responses that only differ in whitespace hash the same
+# str -> str
+def response_digest(code):
+    return hashlib.sha256(normalize_response(code).encode("utf-8")).hexdigest()